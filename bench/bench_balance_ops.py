@@ -0,0 +1,60 @@
+"""Стоимость операций с балансами без конкуренции.
+
+Запуск из корня репозитория: python bench/bench_balance_ops.py [число операций]
+
+Меряются debit_if_sufficient, transfer_balance и вход/выход user_locks
+для двух пользователей. Записи в БД только ставятся в очередь, как в боте
+между сбросами.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def bench_debit(n: int) -> float:
+    bot.set_balance(1, n)
+    started = time.perf_counter()
+    for _ in range(n):
+        bot.debit_if_sufficient(1, 1)
+    elapsed = time.perf_counter() - started
+    assert bot.get_balance(1) == 0
+    return elapsed
+
+
+def bench_transfer(n: int) -> float:
+    bot.set_balance(1, n)
+    bot.set_balance(2, 0)
+    started = time.perf_counter()
+    for _ in range(n):
+        bot.transfer_balance(1, 2, 1)
+    elapsed = time.perf_counter() - started
+    assert bot.get_balance(1) == 0 and bot.get_balance(2) == n
+    return elapsed
+
+
+async def bench_locks(n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        async with bot.user_locks(1, 2):
+            pass
+    return time.perf_counter() - started
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    debit_time = bench_debit(n)
+    transfer_time = bench_transfer(n)
+    locks_time = asyncio.run(bench_locks(n))
+    print(f"{n} операций, на одну:")
+    print(f"  debit_if_sufficient: {debit_time / n * 1e6:.2f} мкс")
+    print(f"  transfer_balance: {transfer_time / n * 1e6:.2f} мкс")
+    print(f"  user_locks (2 пользователя): {locks_time / n * 1e6:.2f} мкс")
+
+
+if __name__ == "__main__":
+    main()
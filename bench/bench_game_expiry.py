@@ -0,0 +1,138 @@
+"""Сравнение удаления игр по таймеру: куча дедлайнов против обхода games.
+
+Запуск из корня репозитория: python bench/bench_game_expiry.py [число игр]
+
+Для каждого способа:
+- стоимость одного срабатывания, когда истекает 1% игр;
+- полная стоимость жизненного цикла: регистрация, отмена половины игр
+  (вступили/отменили) и удаление остальных.
+Скан — логика старого cleanup_worker (обход games раз в 30 с).
+"""
+import heapq
+import os
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+GAME_TTL_SECONDS = bot.GAME_TTL_SECONDS
+
+
+def make_games(n: int, now: datetime) -> dict[int, dict]:
+    # создание игр равномерно размазано по окну TTL
+    return {
+        gid: {
+            "id": gid,
+            "creator_id": gid,
+            "opponent_id": None,
+            "bet": 10,
+            "finished": False,
+            "created_at": now - timedelta(seconds=GAME_TTL_SECONDS * gid / n),
+        }
+        for gid in range(1, n + 1)
+    }
+
+
+def scan_expired(games: dict[int, dict], now: datetime) -> list[int]:
+    """Один проход старого cleanup_worker."""
+    to_delete = []
+    for gid, g in list(games.items()):
+        if g["finished"]:
+            continue
+        if g["opponent_id"] is not None:
+            continue
+        if (now - g["created_at"]).total_seconds() > GAME_TTL_SECONDS:
+            to_delete.append(gid)
+    return to_delete
+
+
+def heap_expired(now: float) -> list[int]:
+    """Один проход game_expiry_worker по куче бота (без await и уведомлений)."""
+    heap, deadlines = bot._game_expiry_heap, bot._game_deadlines
+    expired = []
+    while heap and heap[0][0] <= now:
+        deadline, gid = heapq.heappop(heap)
+        if deadlines.get(gid) != deadline:
+            continue
+        del deadlines[gid]
+        expired.append(gid)
+    return expired
+
+
+def reset_heap():
+    bot._game_expiry_heap.clear()
+    bot._game_deadlines.clear()
+
+
+def bench_tick(n: int):
+    now = datetime.now(UTC)
+    games = make_games(n, now)
+    # «сейчас» сдвинуто так, чтобы истёк ровно 1% самых старых игр
+    tick_at = now + timedelta(seconds=GAME_TTL_SECONDS / 100)
+
+    started = time.perf_counter()
+    scanned = scan_expired(games, tick_at)
+    scan_time = time.perf_counter() - started
+
+    reset_heap()
+    base = time.monotonic()
+    for gid, g in games.items():
+        # дедлайн отсчитываем от base, а не от момента вызова: регистрация 100k игр не мгновенна
+        age = (now - g["created_at"]).total_seconds()
+        bot.schedule_game_expiry(gid, GAME_TTL_SECONDS - age - (time.monotonic() - base))
+    started = time.perf_counter()
+    popped = heap_expired(base + GAME_TTL_SECONDS / 100)
+    heap_time = time.perf_counter() - started
+
+    # на границе окна часы двух способов могут разойтись на пару игр
+    assert abs(len(scanned) - len(popped)) <= 2
+    return len(scanned), scan_time, heap_time
+
+
+def bench_lifecycle(n: int):
+    """Регистрация n игр, отмена половины, срабатывание остальных.
+
+    Скан за время жизни игры делает GAME_TTL_SECONDS / 30 проходов по всем открытым играм.
+    """
+    now = datetime.now(UTC)
+    games = make_games(n, now)
+    started = time.perf_counter()
+    for gid in range(1, n + 1, 2):
+        games[gid]["opponent_id"] = 1
+    passes = GAME_TTL_SECONDS // 30
+    for i in range(passes):
+        for gid in scan_expired(games, now + timedelta(seconds=30 * (i + 1))):
+            del games[gid]
+    scan_time = time.perf_counter() - started
+
+    reset_heap()
+    started = time.perf_counter()
+    base = time.monotonic()
+    for gid in range(1, n + 1):
+        bot.schedule_game_expiry(gid, GAME_TTL_SECONDS * gid / n)
+    for gid in range(1, n + 1, 2):
+        bot.cancel_game_expiry(gid)
+    expired = heap_expired(base + GAME_TTL_SECONDS + 1)
+    heap_time = time.perf_counter() - started
+
+    assert len(expired) == n // 2
+    return scan_time, heap_time
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    expired, scan_time, heap_time = bench_tick(n)
+    print(f"{n} открытых игр, истекает {expired}:")
+    print(f"  одно срабатывание: скан {scan_time * 1000:.1f} мс, куча {heap_time * 1000:.2f} мс")
+    scan_time, heap_time = bench_lifecycle(n)
+    print(
+        f"  полный цикл (регистрация, отмена половины, удаление): "
+        f"скан {scan_time * 1000:.1f} мс, куча {heap_time * 1000:.1f} мс"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import asyncio
-import random
+import bisect
+import heapq
 import re
-from datetime import datetime, timedelta, UTC
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, UTC
 
-import aiohttp
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import (
@@ -12,15 +15,37 @@ from aiogram.types import (
     CallbackQuery,
 )
 
+from fair import new_server_seed, seed_hash, roll_message, roll_dice
+from raffle import new_raffle_round, raffle_add_bet, raffle_chance, raffle_draw
+from outbox import (
+    start_outbox,
+    close_outbox,
+    queue_message,
+    format_outbox_stats,
+    PRIORITY_GAME,
+    PRIORITY_NORMAL,
+    PRIORITY_ADMIN,
+)
+from http_client import get_json, stream_sse, format_http_stats, close_http
 from db import (
     init_db,
-    upsert_user,
+    close_db,
+    queue_user_update,
+    is_user_dirty,
+    pending_user_updates,
+    load_users,
+    find_user_by_username,
     upsert_game,
+    delete_game,
     get_user_games,
-    get_all_finished_games,
+    get_user_period_stats,
+    settle_game,
+    get_top_profit,
+    rebuild_user_stats,
     upsert_raffle_round,
     add_raffle_bet,
-    add_ton_deposit,
+    add_ton_deposits,
+    get_ton_cursor,
     add_transfer,
 )
 
@@ -35,20 +60,56 @@ TON_WALLET_ADDRESS = "UQCzzlkNLsCGqHTUj1zkD_3CVBMoXw-9Od3dRKGgHaBxysYe"  # пр
 
 # 1 рубль = 1 монета (внутренняя валюта бота — монеты)
 # Курс TON→RUB берём через tonapi.io
-TONAPI_RATES_URL = "https://tonapi.io/v2/rates?tokens=ton&currencies=rub"
+TONAPI_BASE_URL = "https://tonapi.io/v2"  # можно подменить на локальную заглушку
+TONAPI_RATES_URL = f"{TONAPI_BASE_URL}/rates?tokens=ton&currencies=rub"
 TON_RUB_CACHE_TTL = 60  # секунд кэша курса
+TON_TX_PAGE_SIZE = 100        # транзакций на страницу при опросе tonapi
+TON_CATCHUP_BATCH_SIZE = 50   # сколько транзакций обрабатывать между сохранениями курсора
+TON_POLL_FAST_INTERVAL = 3    # опрос, пока кто-то недавно открывал меню пополнения (сек)
+TON_POLL_FAST_WINDOW = 600    # сколько секунд после показа адреса опрашивать часто
+TON_POLL_IDLE_INTERVAL = 60   # опрос, когда пополнять никто не собирается (сек)
+TON_POLL_MAX_BACKOFF = 600    # потолок интервала при ошибках tonapi (сек)
+TON_DEPOSIT_STREAMING = False  # ловить пополнения через SSE-поток tonapi вместо опроса
+TON_STREAM_RETRY_DELAY = 60   # сколько секунд опрашивать после обрыва потока до переподключения
+TON_CREDIT_QUEUE_SIZE = 20    # пачек транзакций между разбором и зачислением
+TON_NOTIFY_QUEUE_SIZE = 1000  # уведомлений о пополнениях в очереди на отправку
 
 START_BALANCE_COINS = 0  # стартовый баланс (в монетах)
+USER_CACHE_MAX_USERS = 10_000  # сколько пользователей держать в памяти (остальные — в БД)
+BALANCE_LOCK_STRIPES = 256     # замков на балансы (пользователь -> uid % BALANCE_LOCK_STRIPES)
 
 HISTORY_LIMIT = 30
 HISTORY_PAGE_SIZE = 10
+HISTORY_CACHE_SIZE = 1000   # сколько пользователей держать в кэше «Мои игры»
+HISTORY_CACHE_TTL = 300     # секунд (окна «сутки/неделя/месяц» сдвигаются со временем)
+RECENT_GAMES_CACHE_SIZE = 500  # сколько сыгранных игр держать в памяти после записи в БД
 GAME_TTL_SECONDS = 120  # через сколько секунд удалять несыгранные игры без соперника
+GAMES_PAGE_SIZE = 10    # игр на странице списка
+# фильтры списка игр по ставке: (подпись, мин. ставка, макс. ставка или None); первый — все игры
+GAMES_STAKE_TIERS = [
+    ("Все", 0, None),
+    ("до 100", 0, 99),
+    ("100–999", 100, 999),
+    ("1000+", 1000, None),
+]
 
 # розыгрыш (банкир)
 RAFFLE_TIMER_SECONDS = 40       # через сколько секунд после появления 2+ игроков запускать розыгрыш
 RAFFLE_MIN_BET = 10             # мин. ставка для розыгрыша (в монетах)
 DICE_MIN_BET = 10               # мин. ставка для костей (в монетах)
+DICE_ANIMATION_SECONDS = 3      # сколько ждать анимацию кубика перед результатом
+# чем бросать кости в новых играх: "telegram" — кубик Telegram (send_dice),
+# "server" — честный бросок на сервере (commit-reveal, без ожидания анимации)
+DICE_ROLL_ENGINE = "telegram"
 RAFFLE_QUICK_BETS = [10, 100, 1000]
+RAFFLE_DELIVERY_REPORTS = 50    # сколько последних отчётов о рассылке итогов розыгрышей хранить
+# комнаты розыгрыша: (название, мин. ставка, макс. ставка или None); ставка идёт в комнату
+# своего уровня, у каждой комнаты свой раунд и свой таймер
+RAFFLE_ROOMS = [
+    ("🥉 Малый банк", RAFFLE_MIN_BET, 99),
+    ("🥈 Средний банк", 100, 999),
+    ("🥇 Крупный банк", 1000, None),
+]
 
 MAIN_ADMIN_ID = 7106398341
 ADMIN_IDS = {MAIN_ADMIN_ID, 783924834}  # админы
@@ -56,16 +117,35 @@ ADMIN_IDS = {MAIN_ADMIN_ID, 783924834}  # админы
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+
+@dp.update.outer_middleware()
+async def load_user_middleware(handler, event, data):
+    """Подгружаем автора апдейта в кэш до вызова хэндлера."""
+    user = data.get("event_from_user")
+    if user:
+        await ensure_users(user.id)
+    return await handler(event, data)
+
 # ========================
 #      ДАННЫЕ В ПАМЯТИ
 # ========================
 
-user_balances: dict[int, int] = {}         # user_id -> balance (монеты = рубли)
+# кэш пользователей: грузятся из БД по требованию (ensure_users), редко активные вытесняются (LRU)
+user_balances: OrderedDict[int, int] = OrderedDict()  # user_id -> balance (монеты = рубли)
 user_usernames: dict[int, str] = {}        # user_id -> username (для переводов и ссылок)
+_pinned_users: set[int] = set()            # не вытеснять из кэша (идёт запись их баланса в БД)
 
-games: dict[int, dict] = {}                # game_id -> game dict (активные и недавно сыгранные)
+games: dict[int, dict] = {}                # game_id -> game dict (ждут соперника или играются)
+recent_games: OrderedDict[int, dict] = OrderedDict()  # сыгранные и уже записанные в БД (последние)
+# индекс игр без соперника: для каждого фильтра GAMES_STAKE_TIERS — отсортированные id
+open_game_ids: list[list[int]] = [[] for _ in GAMES_STAKE_TIERS]
 pending_bet_input: dict[int, bool] = {}    # user_id -> ждём ставку для костей
 next_game_id = 1
+_game_tasks: set[asyncio.Task] = set()      # фоновые расчёты игр (play_game)
+# таймеры удаления игр без соперника: куча по дедлайну, отмена — удаление из _game_deadlines
+_game_expiry_heap: list[tuple[float, int]] = []  # (дедлайн по time.monotonic, game_id)
+_game_deadlines: dict[int, float] = {}           # game_id -> действующий дедлайн
+_game_expiry_wakeup = asyncio.Event()            # будит воркер, если появился более ранний дедлайн
 
 # вывод (заявки)
 pending_withdraw_step: dict[int, str] = {}  # user_id -> "amount" / "details"
@@ -76,19 +156,38 @@ pending_transfer_step: dict[int, str] = {}  # user_id -> "target" / "amount_tran
 temp_transfer: dict[int, dict] = {}         # user_id -> {"target_id": int}
 
 # розыгрыш (банкир)
-raffle_round: dict | None = None    # текущий розыгрыш
-raffle_task: asyncio.Task | None = None
+raffle_rounds: dict[int, dict] = {}             # комната -> текущий раунд
+raffle_tasks: dict[int, asyncio.Task] = {}      # комната -> таймер розыгрыша
+# round_id -> {"room", "total", "sent", "failed", "blocked"}: доставка итогов участникам
+raffle_delivery: OrderedDict[int, dict] = OrderedDict()
 next_raffle_id: int = 1
 pending_raffle_bet_input: dict[int, bool] = {}  # ввод произвольной суммы для розыгрыша
 
-# пополнение через TON: храним обработанные транзакции, чтобы не дублировать начисления
-processed_ton_tx: set[str] = set()
+# кэш «Мои игры»: user_id -> (время расчёта, текст статистики, история), LRU
+_history_cache: OrderedDict[int, tuple[float, str, list[dict]]] = OrderedDict()
+# user_id -> флаги идущих расчётов (по одному на вызов): [True], если кэш сбросили во время расчёта
+_history_inflight: dict[int, list[list[bool]]] = {}
 
 # кэш курса TON→RUB
 _ton_rate_cache: dict[str, float | datetime] = {
     "value": 0.0,
     "updated": datetime.fromtimestamp(0, tz=UTC),
 }
+_ton_rate_refresh: asyncio.Task | None = None  # текущий запрос курса (single-flight)
+
+# адаптивный опрос пополнений
+_deposit_menu_shown_at: float = float("-inf")  # time.monotonic() последнего показа адреса
+_deposit_activity = asyncio.Event()            # будит ton_deposit_worker досрочно
+ton_poll_interval: float = TON_POLL_IDLE_INTERVAL  # текущий интервал опроса (для метрик)
+ton_ingest_mode: str = "polling"                   # "polling" / "streaming" (для метрик)
+
+# конвейер пополнений: разбор -> (очередь) -> зачисление + запись в БД -> (очередь) -> уведомления
+_deposit_credit_queue: asyncio.Queue = asyncio.Queue(maxsize=TON_CREDIT_QUEUE_SIZE)
+_deposit_notify_queue: asyncio.Queue = asyncio.Queue(maxsize=TON_NOTIFY_QUEUE_SIZE)
+_ton_enqueued_lt: dict[str, int] = {}  # кошелёк -> lt последней транзакции, отданной на зачисление
+deposit_stage_stats: dict[str, dict[str, float]] = {
+    stage: {"items": 0, "seconds": 0.0} for stage in ("parse", "credit", "notify")
+}
 
 
 # ========================
@@ -99,60 +198,178 @@ def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
 
-def get_balance(uid: int) -> int:
-    """Возвращает баланс в монетах (аналог рублей)."""
-    if uid not in user_balances:
-        user_balances[uid] = START_BALANCE_COINS
-    return user_balances[uid]
+async def ensure_users(*uids: int):
+    """Подгрузить пользователей в кэш из БД.
 
+    Вызывать перед get_balance/change_balance для пользователя, который мог быть
+    вытеснен: между ensure_users и изменением баланса не должно быть await.
+    """
+    missing = [uid for uid in uids if uid not in user_balances]
+    if missing:
+        rows = await load_users(missing)
+        for uid, (uname, bal) in rows.items():
+            if uid in user_balances:
+                continue
+            user_balances[uid] = bal
+            if uname and uid not in user_usernames:
+                user_usernames[uid] = uname
+    for uid in uids:
+        if uid in user_balances:
+            user_balances.move_to_end(uid)
+    _evict_users(keep=uids)
 
-def _schedule_upsert_user(uid: int):
-    """Фоновое сохранение пользователя в БД (баланс + username)."""
-    username = user_usernames.get(uid)
-    balance = user_balances.get(uid, 0)
-    try:
-        asyncio.create_task(upsert_user(uid, username, balance))
-    except RuntimeError:
-        # если event loop ещё не запущен (редкий случай)
-        pass
+
+def _evict_users(keep: tuple[int, ...] = ()):
+    """Вытеснить самых давно использованных пользователей сверх USER_CACHE_MAX_USERS.
+
+    Пользователи с незаписанными изменениями не вытесняются до сброса в БД.
+    """
+    excess = len(user_balances) - USER_CACHE_MAX_USERS
+    if excess <= 0:
+        return
+    victims = []
+    for uid in user_balances:
+        if uid in keep or uid in _pinned_users or is_user_dirty(uid):
+            continue
+        victims.append(uid)
+        if len(victims) >= excess:
+            break
+    for uid in victims:
+        del user_balances[uid]
+        user_usernames.pop(uid, None)
+
+
+def get_balance(uid: int) -> int:
+    """Возвращает баланс в монетах (аналог рублей)."""
+    bal = user_balances.get(uid)
+    if bal is None:
+        return START_BALANCE_COINS
+    user_balances.move_to_end(uid)
+    return bal
 
 
 def change_balance(uid: int, delta: int):
-    get_balance(uid)
-    user_balances[uid] += delta
-    _schedule_upsert_user(uid)
+    set_balance(uid, get_balance(uid) + delta)
 
 
 def set_balance(uid: int, value: int):
     user_balances[uid] = value
-    _schedule_upsert_user(uid)
+    user_balances.move_to_end(uid)
+    # запись в БД отложенная: изменения склеиваются и сбрасываются пачкой
+    queue_user_update(uid, balance=value)
+
+
+def debit_if_sufficient(uid: int, amount: int) -> bool:
+    """Списать amount, только если хватает монет; проверка и списание без await между ними."""
+    bal = get_balance(uid)
+    if amount <= 0 or bal < amount:
+        return False
+    set_balance(uid, bal - amount)
+    return True
+
+
+def transfer_balance(from_uid: int, to_uid: int, amount: int) -> bool:
+    """Перевести монеты между пользователями целиком или не переводить вовсе."""
+    if not debit_if_sufficient(from_uid, amount):
+        return False
+    change_balance(to_uid, amount)
+    return True
+
+
+# замки на пользователей для операций, где между проверкой баланса и записью в БД есть await;
+# храним фиксированное число замков (страйпы), а не по замку на пользователя
+_balance_locks = [asyncio.Lock() for _ in range(BALANCE_LOCK_STRIPES)]
+
+
+@asynccontextmanager
+async def user_locks(*uids: int):
+    """Не пускать параллельно операции с балансами этих пользователей.
+
+    Страйпы берутся по возрастанию номера, поэтому два перевода навстречу друг другу
+    не блокируют друг друга навсегда.
+    """
+    stripes = sorted({uid % BALANCE_LOCK_STRIPES for uid in uids})
+    for s in stripes:
+        await _balance_locks[s].acquire()
+    try:
+        yield
+    finally:
+        for s in reversed(stripes):
+            _balance_locks[s].release()
+
+
+async def _retry_until_ok(make_call, what: str):
+    """Повторять запись в БД, пока не пройдёт: деньги уже изменены в памяти."""
+    delay = 1
+    while True:
+        try:
+            return await make_call()
+        except Exception as e:
+            print(f"Ошибка БД ({what}), повтор:", e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
 
 
 def format_coins(n: int) -> str:
     return f"{n:,}".replace(",", " ")
 
 
-async def get_ton_rub_rate() -> float:
-    """Получить курс TON→RUB через tonapi.io (с простым кэшем)."""
-    now = datetime.now(UTC)
-    cached_value = _ton_rate_cache["value"]
+async def _fetch_ton_rub_rate() -> float:
+    data = await get_json("tonapi", TONAPI_RATES_URL)
+    # структура по доке: {"rates": {"TON": {"prices": {"RUB": 123.45}}}}
+    rate = float(data["rates"]["TON"]["prices"]["RUB"])
+    _ton_rate_cache["value"] = rate
+    _ton_rate_cache["updated"] = datetime.now(UTC)
+    return rate
+
+
+async def refresh_ton_rub_rate() -> float:
+    """Обновить курс; параллельные вызовы ждут один и тот же запрос к tonapi."""
+    global _ton_rate_refresh
+    if _ton_rate_refresh is None or _ton_rate_refresh.done():
+        _ton_rate_refresh = asyncio.create_task(_fetch_ton_rub_rate())
+    return await asyncio.shield(_ton_rate_refresh)
+
+
+def get_ton_rub_rate_age() -> float:
+    """Сколько секунд назад курс был получен от tonapi."""
     updated: datetime = _ton_rate_cache["updated"]  # type: ignore
+    return (datetime.now(UTC) - updated).total_seconds()
 
-    if cached_value and (now - updated).total_seconds() < TON_RUB_CACHE_TTL:
+
+async def get_ton_rub_rate() -> float:
+    """Курс TON→RUB через tonapi.io.
+
+    Сразу отдаёт последнее известное значение; если оно устарело — обновляет в фоне.
+    В сеть ждём только при самом первом запросе, пока курса ещё нет.
+    """
+    cached_value = _ton_rate_cache["value"]
+    if cached_value:
+        if get_ton_rub_rate_age() >= TON_RUB_CACHE_TTL and (
+            _ton_rate_refresh is None or _ton_rate_refresh.done()
+        ):
+            asyncio.create_task(_refresh_ton_rub_rate_quietly())
         return float(cached_value)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(TONAPI_RATES_URL, timeout=10) as resp:
-                data = await resp.json()
-        # структура по доке: {"rates": {"TON": {"prices": {"RUB": 123.45}}}}
-        rate = float(data["rates"]["TON"]["prices"]["RUB"])
-        _ton_rate_cache["value"] = rate
-        _ton_rate_cache["updated"] = now
-        return rate
+        return await refresh_ton_rub_rate()
     except Exception:
-        # если не удалось взять курс — возвращаем последний кэш или дефолт
-        return float(cached_value or 100.0)
+        # если не удалось взять курс — возвращаем дефолт
+        return 100.0
+
+
+async def _refresh_ton_rub_rate_quietly():
+    try:
+        await refresh_ton_rub_rate()
+    except Exception as e:
+        print("Не удалось обновить курс TON:", e)
+
+
+async def ton_rate_worker():
+    """Фоново обновляет курс, чтобы пользователи не ждали tonapi."""
+    while True:
+        await _refresh_ton_rub_rate_quietly()
+        await asyncio.sleep(TON_RUB_CACHE_TTL / 2)
 
 
 async def format_balance_text(uid: int) -> str:
@@ -185,37 +402,79 @@ def bottom_menu():
 
 
 def register_user(user: types.User):
-    if user.username:
+    if user.username and user_usernames.get(user.id) != user.username:
         user_usernames[user.id] = user.username
-        _schedule_upsert_user(user.id)
+        queue_user_update(user.id, username=user.username)
 
 
 # ========================
 #      СПИСОК ИГР (КОСТИ)
 # ========================
 
-def build_games_keyboard(uid: int) -> InlineKeyboardMarkup:
+def _stake_tiers(bet: int) -> list[int]:
+    return [
+        i for i, (_, lo, hi) in enumerate(GAMES_STAKE_TIERS)
+        if bet >= lo and (hi is None or bet <= hi)
+    ]
+
+
+def index_open_game(g: dict):
+    """Добавить игру в список ожидающих соперника."""
+    for tier in _stake_tiers(g["bet"]):
+        bisect.insort(open_game_ids[tier], g["id"])
+
+
+def unindex_open_game(g: dict):
+    """Убрать игру из списка (соперник вступил, ставку отменили или истёк таймер)."""
+    for tier in _stake_tiers(g["bet"]):
+        ids = open_game_ids[tier]
+        i = bisect.bisect_left(ids, g["id"])
+        if i < len(ids) and ids[i] == g["id"]:
+            del ids[i]
+
+
+def build_games_keyboard(uid: int, tier: int = 0, page: int = 0) -> InlineKeyboardMarkup:
     rows = []
 
     rows.append([
         InlineKeyboardButton(text="✅Создать игру", callback_data="create_game"),
-        InlineKeyboardButton(text="🔄Обновить", callback_data="refresh_games"),
+        InlineKeyboardButton(text="🔄Обновить", callback_data=f"refresh_games:{tier}:{page}"),
+    ])
+
+    rows.append([
+        InlineKeyboardButton(
+            text=f"• {label}" if i == tier else label,
+            callback_data=f"games_page:{i}:0",
+        )
+        for i, (label, _, _) in enumerate(GAMES_STAKE_TIERS)
     ])
 
-    active = [g for g in games.values() if g["opponent_id"] is None]
-    active.sort(key=lambda x: x["id"], reverse=True)
+    # новые игры сверху: страница — срез с конца отсортированного списка id
+    ids = open_game_ids[tier]
+    pages = max(1, (len(ids) + GAMES_PAGE_SIZE - 1) // GAMES_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+    end = len(ids) - page * GAMES_PAGE_SIZE
+    start = max(0, end - GAMES_PAGE_SIZE)
 
-    for g in active:
-        txt = f"🎲Игра #{g['id']} | {format_coins(g['bet'])} монет"
+    for gid in reversed(ids[start:end]):
+        g = games[gid]
+        txt = f"🎲Игра #{gid} | {format_coins(g['bet'])} монет"
         if g["creator_id"] == uid:
             rows.append([
-                InlineKeyboardButton(text=txt, callback_data=f"game_my:{g['id']}")
+                InlineKeyboardButton(text=txt, callback_data=f"game_my:{gid}")
             ])
         else:
             rows.append([
-                InlineKeyboardButton(text=txt, callback_data=f"game_open:{g['id']}")
+                InlineKeyboardButton(text=txt, callback_data=f"game_open:{gid}")
             ])
 
+    if pages > 1:
+        rows.append([
+            InlineKeyboardButton(text="<", callback_data=f"games_page:{tier}:{max(0, page - 1)}"),
+            InlineKeyboardButton(text=f"{page+1}/{pages}", callback_data="ignore"),
+            InlineKeyboardButton(text=">", callback_data=f"games_page:{tier}:{min(pages - 1, page + 1)}"),
+        ])
+
     rows.append([
         InlineKeyboardButton(text="📋 Мои игры", callback_data="my_games:0"),
         InlineKeyboardButton(text="🏆 Рейтинг", callback_data="rating"),
@@ -258,32 +517,15 @@ def calculate_profit(uid: int, g: dict) -> int:
 
 
 async def build_user_stats_and_history(uid: int):
-    now = datetime.now(UTC)
-    finished = await get_user_games(uid)
+    now_ts = int(datetime.now(UTC).timestamp())
 
+    # считаем по часовым/суточным корзинам, а не по всем играм пользователя
     stats = {
-        "month": {"games": 0, "profit": 0},
-        "week": {"games": 0, "profit": 0},
-        "day": {"games": 0, "profit": 0},
+        "month": await get_user_period_stats(uid, now_ts - 30 * 86400),
+        "week": await get_user_period_stats(uid, now_ts - 7 * 86400),
+        "day": await get_user_period_stats(uid, now_ts - 86400),
     }
 
-    for g in finished:
-        if not g.get("finished_at"):
-            continue
-        finished_at = datetime.fromisoformat(g["finished_at"])
-        delta = now - finished_at
-        p = calculate_profit(uid, g)
-
-        if delta <= timedelta(days=30):
-            stats["month"]["games"] += 1
-            stats["month"]["profit"] += p
-        if delta <= timedelta(days=7):
-            stats["week"]["games"] += 1
-            stats["week"]["profit"] += p
-        if delta <= timedelta(days=1):
-            stats["day"]["games"] += 1
-            stats["day"]["profit"] += p
-
     def ps(v): return ("+" if v > 0 else "") + str(v)
 
     stats_text = (
@@ -296,7 +538,7 @@ async def build_user_stats_and_history(uid: int):
     )
 
     history = []
-    for g in finished[:HISTORY_LIMIT]:
+    for g in await get_user_games(uid, HISTORY_LIMIT):
         if uid == g["creator_id"]:
             my = g["creator_roll"]
             opp = g["opponent_roll"]
@@ -323,6 +565,39 @@ async def build_user_stats_and_history(uid: int):
     return stats_text, history
 
 
+async def get_user_stats_and_history(uid: int):
+    """build_user_stats_and_history с кэшем, чтобы листание страниц не ходило в БД."""
+    entry = _history_cache.get(uid)
+    if entry and time.monotonic() - entry[0] < HISTORY_CACHE_TTL:
+        _history_cache.move_to_end(uid)
+        return entry[1], entry[2]
+
+    invalidated = [False]
+    _history_inflight.setdefault(uid, []).append(invalidated)
+    try:
+        stats, history = await build_user_stats_and_history(uid)
+    finally:
+        calls = _history_inflight[uid]
+        # удаляем именно свой флаг (по identity: флаги с одинаковым значением равны)
+        calls[:] = [f for f in calls if f is not invalidated]
+        if not calls:
+            del _history_inflight[uid]
+
+    if not invalidated[0]:
+        _history_cache[uid] = (time.monotonic(), stats, history)
+        _history_cache.move_to_end(uid)
+        while len(_history_cache) > HISTORY_CACHE_SIZE:
+            _history_cache.popitem(last=False)
+    return stats, history
+
+
+def invalidate_user_history(*uids: int):
+    for uid in uids:
+        _history_cache.pop(uid, None)
+        for invalidated in _history_inflight.get(uid, ()):
+            invalidated[0] = True
+
+
 def build_history_keyboard(history: list[dict], page: int) -> InlineKeyboardMarkup:
     rows = []
 
@@ -360,24 +635,15 @@ def build_history_keyboard(history: list[dict], page: int) -> InlineKeyboardMark
 # ========================
 
 async def build_rating_text() -> str:
-    profits: dict[int, int] = {}
-    finished = await get_all_finished_games()
-
-    for g in finished:
-        for uid in (g["creator_id"], g["opponent_id"]):
-            if uid is None:
-                continue
-            profits.setdefault(uid, 0)
-            profits[uid] += calculate_profit(uid, g)
-
-    if not profits:
+    top = await get_top_profit(10)
+    if not top:
         return "🏆 Рейтинг пока пуст — ещё нет завершённых игр."
 
-    top = sorted(profits.items(), key=lambda x: x[1], reverse=True)[:10]
     place_emoji = ["🥇", "🥈", "🥉"] + ["🏅"] * 7
 
     lines = ["🏆 ТОП игроков по профиту (монеты):\n"]
-    for i, (uid, prof) in enumerate(top, start=1):
+    for i, row in enumerate(top, start=1):
+        uid, prof = row["user_id"], row["profit"]
         emoji = place_emoji[i - 1] if i <= len(place_emoji) else "🏅"
         sign = "+" if prof > 0 else ""
         lines.append(f"{emoji} {i}. ID {uid}: {sign}{prof} монет")
@@ -390,8 +656,8 @@ async def build_rating_text() -> str:
 # ========================
 
 async def telegram_roll(uid: int) -> int:
+    # значение известно сразу, анимацию ждёт вызывающий (одну на оба броска)
     msg = await bot.send_dice(uid, emoji="🎲")
-    await asyncio.sleep(3)
     return msg.dice.value
 
 
@@ -404,8 +670,14 @@ async def play_game(gid: int):
     o = g["opponent_id"]
     bet = g["bet"]
 
-    cr = await telegram_roll(c)
-    orr = await telegram_roll(o)
+    if g.get("roll_engine") == "server":
+        cr, orr = roll_dice(g["server_seed"], roll_message(gid, c, o, g.get("client_seed") or ""))
+    else:
+        cr, orr = await asyncio.gather(telegram_roll(c), telegram_roll(o))
+        await asyncio.sleep(DICE_ANIMATION_SECONDS)
+
+    # последний await перед расчётом: дальше игра либо не завершена, либо записана
+    await ensure_users(c, o, MAIN_ADMIN_ID)
 
     g["creator_roll"] = cr
     g["opponent_roll"] = orr
@@ -434,8 +706,23 @@ async def play_game(gid: int):
 
     g["winner"] = winner
 
-    # сохраняем результат игры в БД
-    await upsert_game(g)
+    # сохраняем результат игры и статистику игроков в БД; выплаты уже в кэше, поэтому
+    # повторяем до успеха — иначе после рестарта игра доигралась бы второй раз
+    profits = {c: calculate_profit(c, g), o: calculate_profit(o, g)}
+    await _retry_until_ok(lambda: settle_game(g, profits, (c, o, MAIN_ADMIN_ID)), "расчёт игры")
+    retire_game(gid)
+    invalidate_user_history(c, o)
+    await ensure_users(c, o)
+
+    fair_text = ""
+    if g.get("roll_engine") == "server":
+        fair_text = (
+            f"\n\n🔐 Сид: {g['server_seed']}\n"
+            f"Сид соперника: {g.get('client_seed') or '—'}\n"
+            f"Проверка: sha256(сид) = {g['seed_hash']}, броски — HMAC-SHA256(сид, "
+            f"\"{roll_message(gid, c, o, g.get('client_seed') or '')}:0\"), "
+            f"байты < 252 → байт % 6 + 1"
+        )
 
     for user in (c, o):
         is_creator = (user == c)
@@ -462,77 +749,157 @@ async def play_game(gid: int):
             f"🧑‍🤝‍🧑 Результат соперника: {their}\n\n"
             f"{result_text}\n"
             f"💼 Баланс: {get_balance(user)} монет"
+            f"{fair_text}"
         )
 
-        await bot.send_message(user, txt)
+        queue_message(user, txt, PRIORITY_GAME)
+
+
+async def _run_game(gid: int):
+    """play_game под присмотром: если игра упала до расчёта — возвращаем ставки."""
+    try:
+        await play_game(gid)
+    except Exception as e:
+        print(f"Ошибка в игре #{gid}:", e)
+        g = games.get(gid)
+        if not g:
+            return
+        if g["finished"]:
+            # результат уже записан (settle_game повторяется до успеха), упало то, что после
+            retire_game(gid)
+            return
+        games.pop(gid, None)
+        players = [uid for uid in (g["creator_id"], g["opponent_id"]) if uid is not None]
+        await _retry_until_ok(lambda: ensure_users(*players), "возврат ставок")
+        for uid in players:
+            change_balance(uid, g["bet"])
+        # строку игры удаляем вместе с возвратом: иначе restore_state доиграл бы её после рестарта
+        await _retry_until_ok(lambda: delete_game(gid, players), "возврат ставок")
+        for uid in players:
+            queue_message(
+                uid,
+                f"⚠️ Игра №{gid} не состоялась из-за ошибки.\n"
+                f"💰 {format_coins(g['bet'])} монет возвращены на баланс.",
+                PRIORITY_GAME,
+            )
+
+
+def retire_game(gid: int):
+    """Убрать сыгранную игру из games после записи в БД; держим только последние."""
+    g = games.pop(gid, None)
+    if g is None:
+        return
+    recent_games[gid] = g
+    while len(recent_games) > RECENT_GAMES_CACHE_SIZE:
+        recent_games.popitem(last=False)
+
+
+def start_game(gid: int):
+    """Запустить расчёт игры в фоне, чтобы хэндлер вступления сразу отвечал."""
+    task = asyncio.create_task(_run_game(gid))
+    _game_tasks.add(task)
+    task.add_done_callback(_game_tasks.discard)
 
 
 # ========================
 #      АВТОУДАЛЕНИЕ ИГР
 # ========================
 
-async def cleanup_worker():
-    while True:
-        now = datetime.now(UTC)
-        to_delete = []
+def schedule_game_expiry(gid: int, delay: float = GAME_TTL_SECONDS):
+    """Поставить таймер удаления игры, если к ней никто не вступит."""
+    deadline = time.monotonic() + delay
+    _game_deadlines[gid] = deadline
+    heapq.heappush(_game_expiry_heap, (deadline, gid))
+    if _game_expiry_heap[0] == (deadline, gid):
+        _game_expiry_wakeup.set()
 
-        for gid, g in list(games.items()):
-            if g["finished"]:
-                continue
-            if g["opponent_id"] is not None:
-                continue
 
-            created_at = g["created_at"]
-            if (now - created_at).total_seconds() > GAME_TTL_SECONDS:
-                to_delete.append(gid)
+def cancel_game_expiry(gid: int):
+    """Снять таймер (соперник вступил или ставку отменили).
 
-        for gid in to_delete:
-            g = games.get(gid)
-            if not g:
-                continue
-            creator_id = g["creator_id"]
-            bet = g["bet"]
-            change_balance(creator_id, bet)
-            del games[gid]
+    Запись остаётся в куче и будет пропущена, когда до неё дойдёт очередь.
+    """
+    _game_deadlines.pop(gid, None)
+
+
+async def expire_game(gid: int):
+    g = games.get(gid)
+    if not g or g["finished"] or g["opponent_id"] is not None:
+        return
+    creator_id = g["creator_id"]
+    bet = g["bet"]
+    await ensure_users(creator_id)
+    # пока грузили пользователя, к игре могли вступить или отменить её
+    if games.get(gid) is not g or g["opponent_id"] is not None:
+        return
+    unindex_open_game(g)
+    change_balance(creator_id, bet)
+    del games[gid]
+    await _retry_until_ok(lambda: delete_game(gid, (creator_id,)), "удаление игры по таймеру")
+    queue_message(
+        creator_id,
+        f"⏳ Ваша игра №{gid} была удалена по таймеру.\n"
+        f"💰 {format_coins(bet)} монет возвращены на баланс."
+    )
+
+
+async def game_expiry_worker():
+    """Удаляет игры без соперника точно в их дедлайн (O(log n) на игру, без обхода games)."""
+    while True:
+        now = time.monotonic()
+        while _game_expiry_heap and _game_expiry_heap[0][0] <= now:
+            deadline, gid = heapq.heappop(_game_expiry_heap)
+            if _game_deadlines.get(gid) != deadline:
+                continue  # таймер отменён или переставлен
+            del _game_deadlines[gid]
             try:
-                await bot.send_message(
-                    creator_id,
-                    f"⏳ Ваша игра №{gid} была удалена по таймеру.\n"
-                    f"💰 {format_coins(bet)} монет возвращены на баланс."
-                )
-            except Exception:
-                pass
+                await expire_game(gid)
+            except Exception as e:
+                print(f"[GAMES] Ошибка удаления игры №{gid} по таймеру: {e}")
+            now = time.monotonic()
 
-        await asyncio.sleep(30)
+        timeout = _game_expiry_heap[0][0] - now if _game_expiry_heap else None
+        _game_expiry_wakeup.clear()
+        try:
+            await asyncio.wait_for(_game_expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ========================
 #      РОЗЫГРЫШ (БАНКИР)
 # ========================
 
+def raffle_room_for(amount: int) -> int:
+    for room, (_, lo, hi) in enumerate(RAFFLE_ROOMS):
+        if amount >= lo and (hi is None or amount <= hi):
+            return room
+    raise ValueError(f"Минимальная ставка {RAFFLE_MIN_BET} монет")
+
+
 def build_raffle_text(uid: int) -> str:
-    global raffle_round
-    if raffle_round is None or not raffle_round.get("bets"):
-        return (
-            "👥 Розыгрыш начнётся, когда будет минимум два участника.\n"
-            "🧔 Станьте первым, кто сделает ставку."
+    lines = []
+    for room, (name, lo, hi) in enumerate(RAFFLE_ROOMS):
+        limits = f"{format_coins(lo)}–{format_coins(hi)}" if hi else f"от {format_coins(lo)}"
+        raffle_round = raffle_rounds.get(room)
+        if raffle_round is None or not raffle_round["bets"]:
+            lines.append(f"{name} ({limits} монет)\n🧔 Ставок пока нет.")
+            continue
+        user_bet = raffle_round["bets"].get(uid, 0)
+        chance_text = f"{raffle_chance(raffle_round, uid):.1f}%" if user_bet > 0 else "0%"
+        lines.append(
+            f"{name} ({limits} монет) — #{raffle_round['id']}\n"
+            f"👨‍👩‍👧 Участников: {len(raffle_round['bets'])}\n"
+            f"💰 Банк: {format_coins(raffle_round['total_bank'])} монет\n"
+            f"🎯 Ваша ставка: {format_coins(user_bet)}\n"
+            f"🎲 Ваш шанс: {chance_text}"
         )
-    bets = raffle_round["bets"]
-    total_bank = sum(bets.values())
-    players_count = len(bets)
-    user_bet = bets.get(uid, 0)
-    if total_bank > 0 and user_bet > 0:
-        chance = user_bet / total_bank * 100
-        chance_text = f"{chance:.1f}%"
-    else:
-        chance_text = "0%"
 
     return (
-        f"🎩 Банкир #{raffle_round['id']}\n"
-        f"👨‍👩‍👧 Участников: {players_count}\n"
-        f"💰 Банк: {format_coins(total_bank)} монет\n"
-        f"🎯 Ваша ставка: {format_coins(user_bet)}\n"
-        f"🎲 Ваш шанс: {chance_text}"
+        "🎩 Банкир\n"
+        "👥 Розыгрыш в комнате начнётся, когда будет минимум два участника.\n"
+        "Комната выбирается по сумме ставки.\n\n"
+        + "\n\n".join(lines)
     )
 
 
@@ -559,62 +926,61 @@ async def send_raffle_menu(chat_id: int, uid: int):
     )
 
 
-async def schedule_raffle_draw():
-    global raffle_task
-    if raffle_task is not None and not raffle_task.done():
+async def schedule_raffle_draw(room: int):
+    task = raffle_tasks.get(room)
+    if task is not None and not task.done():
         return
-    raffle_task = asyncio.create_task(raffle_draw_worker())
+    raffle_tasks[room] = asyncio.create_task(raffle_draw_worker(room))
 
 
-async def raffle_draw_worker():
+async def raffle_draw_worker(room: int):
     await asyncio.sleep(RAFFLE_TIMER_SECONDS)
-    await perform_raffle_draw()
-
+    await perform_raffle_draw(room)
 
-async def perform_raffle_draw():
-    global raffle_round, raffle_task, next_raffle_id
 
-    if raffle_round is None or not raffle_round.get("bets"):
+async def perform_raffle_draw(room: int):
+    raffle_round = raffle_rounds.get(room)
+    if raffle_round is None or not raffle_round["bets"]:
         return
 
     bets = raffle_round["bets"]
     if len(bets) < 2:
         return
 
-    total_bank = sum(bets.values())
+    total_bank = raffle_round["total_bank"]
     if total_bank <= 0:
         return
 
-    # взвешенный рандом
-    r = random.uniform(0, total_bank)
-    upto = 0
-    winner_id = None
-    for uid, bet in bets.items():
-        if upto + bet >= r:
-            winner_id = uid
-            break
-        upto += bet
+    # раунд закрываем до первого await: новые ставки сразу идут в следующий раунд комнаты
+    raffle_rounds.pop(room, None)
+    raffle_tasks.pop(room, None)
 
-    if winner_id is None:
-        winner_id = random.choice(list(bets.keys()))
+    winner_id = raffle_draw(raffle_round)
+    room_name = RAFFLE_ROOMS[room][0]
 
     commission = total_bank // 100
     prize = total_bank - commission
 
+    # раунд уже убран из raffle_rounds: при ошибке БД ставки остались бы только в памяти,
+    # а выплата без закрытого раунда — доигралась бы второй раз после рестарта
+    await _retry_until_ok(lambda: ensure_users(winner_id, MAIN_ADMIN_ID), "розыгрыш")
     change_balance(winner_id, prize)
     change_balance(MAIN_ADMIN_ID, commission)
 
-    # обновляем структуру розыгрыша и сохраняем в БД
+    # обновляем структуру розыгрыша и сохраняем в БД вместе с выплатой
     raffle_round["winner_id"] = winner_id
     raffle_round["finished_at"] = datetime.now(UTC)
-    raffle_round["total_bank"] = total_bank
-    await upsert_raffle_round(raffle_round)
+    await _retry_until_ok(
+        lambda: upsert_raffle_round(raffle_round, (winner_id, MAIN_ADMIN_ID)), "розыгрыш"
+    )
 
-    # уведомления участников
+    # уведомления участников: через очередь исходящих, итог доставки — в отчёт раунда
+    await ensure_users(*bets)
+    results = []
     for uid, bet in bets.items():
         if uid == winner_id:
             text = (
-                f"🎉 Вы выиграли розыгрыш #{raffle_round['id']}!\n\n"
+                f"🎉 Вы выиграли розыгрыш #{raffle_round['id']} ({room_name})!\n\n"
                 f"💰 Банк: {format_coins(total_bank)} монет\n"
                 f"💸 Комиссия (1%): {format_coins(commission)}\n"
                 f"🏆 Ваш выигрыш: {format_coins(prize)} монет\n"
@@ -622,68 +988,86 @@ async def perform_raffle_draw():
             )
         else:
             text = (
-                f"❌ Вы проиграли розыгрыш #{raffle_round['id']}.\n\n"
+                f"❌ Вы проиграли розыгрыш #{raffle_round['id']} ({room_name}).\n\n"
                 f"💰 Банк: {format_coins(total_bank)} монет\n"
                 f"💸 Ваша ставка: {format_coins(bet)} монет\n"
                 f"💼 Баланс: {get_balance(uid)}"
             )
-        try:
-            await bot.send_message(uid, text)
-        except Exception:
-            pass
+        results.append(queue_message(uid, text, PRIORITY_GAME))
+    track_raffle_delivery(raffle_round["id"], room, results)
 
     # уведомление админу
-    try:
-        await bot.send_message(
-            MAIN_ADMIN_ID,
-            f"💰 Розыгрыш #{raffle_round['id']} завершён.\n"
-            f"Банк: {format_coins(total_bank)} монет\n"
-            f"Комиссия (1%): {format_coins(commission)} монет\n"
-            f"Победитель: {winner_id}"
-        )
-    except Exception:
-        pass
+    queue_message(
+        MAIN_ADMIN_ID,
+        f"💰 Розыгрыш #{raffle_round['id']} ({room_name}) завершён.\n"
+        f"Банк: {format_coins(total_bank)} монет\n"
+        f"Комиссия (1%): {format_coins(commission)} монет\n"
+        f"Победитель: {winner_id}\n"
+        f"Доставка итогов: /raffledelivery {raffle_round['id']}",
+        PRIORITY_ADMIN,
+    )
 
-    raffle_round = None
-    raffle_task = None
-    next_raffle_id += 1
 
+def track_raffle_delivery(round_id: int, room: int, results: list[asyncio.Future]):
+    """Считать, сколько итогов розыгрыша доставлено, по мере отправки из очереди."""
+    report = {"room": room, "total": len(results), "sent": 0, "failed": 0, "blocked": 0}
+    raffle_delivery[round_id] = report
+    while len(raffle_delivery) > RAFFLE_DELIVERY_REPORTS:
+        raffle_delivery.popitem(last=False)
 
-async def place_raffle_bet(uid: int, amount: int):
-    global raffle_round, next_raffle_id
+    def on_done(fut: asyncio.Future):
+        if not fut.cancelled():
+            report[fut.result()] += 1
+
+    for fut in results:
+        fut.add_done_callback(on_done)
 
+
+def format_raffle_delivery(round_id: int, report: dict) -> str:
+    pending = report["total"] - report["sent"] - report["failed"] - report["blocked"]
+    return (
+        f"#{round_id} ({RAFFLE_ROOMS[report['room']][0]}): "
+        f"отправлено {report['sent']}/{report['total']}, ошибок {report['failed']}, "
+        f"заблокировали бота {report['blocked']}, в очереди {pending}"
+    )
+
+
+async def place_raffle_bet(uid: int, amount: int):
+    """Ставка в комнату по её сумме. Возвращает (комната, банк, ставка игрока, шанс %)."""
     if amount < RAFFLE_MIN_BET:
         raise ValueError(f"Минимальная ставка {RAFFLE_MIN_BET} монет")
+    room = raffle_room_for(amount)
 
-    if get_balance(uid) < amount:
-        raise RuntimeError("Недостаточно монет на балансе")
+    async with user_locks(uid):
+        await ensure_users(uid)
+        if not debit_if_sufficient(uid, amount):
+            raise RuntimeError("Недостаточно монет на балансе")
+        return await _add_raffle_bet(uid, room, amount)
 
-    change_balance(uid, -amount)
 
+async def _add_raffle_bet(uid: int, room: int, amount: int):
+    global next_raffle_id
+
+    raffle_round = raffle_rounds.get(room)
     if raffle_round is None:
-        raffle_round = {
-            "id": next_raffle_id,
-            "bets": {},
-            "created_at": datetime.now(UTC),
-            "finished_at": None,
-            "winner_id": None,
-            "total_bank": 0,
-        }
+        # номер раунда берём сразу: раунды в разных комнатах идут параллельно
+        raffle_round = new_raffle_round(next_raffle_id, room)
+        raffle_rounds[room] = raffle_round
+        next_raffle_id += 1
         await upsert_raffle_round(raffle_round)
 
-    bets = raffle_round["bets"]
-    bets[uid] = bets.get(uid, 0) + amount
+    raffle_add_bet(raffle_round, uid, amount)
 
     await add_raffle_bet(raffle_round["id"], uid, amount)
 
-    total_bank = sum(bets.values())
-    user_bet = bets[uid]
-    chance = user_bet / total_bank * 100 if total_bank > 0 else 0.0
+    total_bank = raffle_round["total_bank"]
+    user_bet = raffle_round["bets"][uid]
+    chance = raffle_chance(raffle_round, uid)
 
-    if len(bets) >= 2:
-        await schedule_raffle_draw()
+    if len(raffle_round["bets"]) >= 2:
+        await schedule_raffle_draw(room)
 
-    return total_bank, user_bet, chance
+    return room, total_bank, user_bet, chance
 
 
 # ========================
@@ -693,7 +1077,6 @@ async def place_raffle_bet(uid: int, amount: int):
 @dp.message(Command("start"))
 async def cmd_start(m: types.Message):
     register_user(m.from_user)
-    get_balance(m.from_user.id)
     await m.answer(
         "Добро пожаловать в игровой бот TON!\n"
         "Здесь вы найдёте кости, розыгрыши и честные игры на монеты.\n"
@@ -775,6 +1158,7 @@ async def cmd_addbalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
+    await ensure_users(uid)
     change_balance(uid, amount)
     await m.answer(f"✅ Баланс {uid} увеличен на {amount} монет. Теперь: {get_balance(uid)}")
 
@@ -790,6 +1174,7 @@ async def cmd_removebalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
+    await ensure_users(uid)
     change_balance(uid, -amount)
     await m.answer(f"✅ Баланс {uid} уменьшен на {amount} монет. Теперь: {get_balance(uid)}")
 
@@ -805,6 +1190,7 @@ async def cmd_setbalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
+    await ensure_users(uid)
     set_balance(uid, amount)
     await m.answer(f"✅ Баланс {uid} установлен на {amount} монет")
 
@@ -814,16 +1200,78 @@ async def cmd_adminprofit(m: types.Message):
     register_user(m.from_user)
     if m.from_user.id != MAIN_ADMIN_ID:
         return await m.answer("⛔ Только основной админ.")
+    await ensure_users(MAIN_ADMIN_ID)
     bal = get_balance(MAIN_ADMIN_ID)
     rate = await get_ton_rub_rate()
     ton_equiv = bal / rate if rate > 0 else 0
     await m.answer(
         f"💸 Баланс админа (накопленная комиссия и игры): {format_coins(bal)} монет.\n"
         f"≈ {ton_equiv:.4f} TON по текущему курсу ({rate:.2f} ₽ за 1 TON).\n"
+        f"Курс обновлён {int(get_ton_rub_rate_age())} с назад.\n"
         f"Эти монеты можно вывести, обменяв TON на рубли."
     )
 
 
+@dp.message(Command("raffledelivery"))
+async def cmd_raffledelivery(m: types.Message):
+    register_user(m.from_user)
+    if not is_admin(m.from_user.id):
+        return await m.answer("⛔ Нет прав.")
+    parts = m.text.split()
+    if len(parts) == 2 and parts[1].isdigit():
+        round_id = int(parts[1])
+        report = raffle_delivery.get(round_id)
+        if report is None:
+            return await m.answer(f"Отчёта о рассылке розыгрыша #{round_id} нет.")
+        return await m.answer("📨 " + format_raffle_delivery(round_id, report))
+    if len(parts) != 1:
+        return await m.answer("Использование: /raffledelivery [round_id]")
+    if not raffle_delivery:
+        return await m.answer("Розыгрышей с рассылкой итогов ещё не было.")
+    recent = list(raffle_delivery.items())[-10:]
+    await m.answer(
+        "📨 Рассылка итогов розыгрышей:\n"
+        + "\n".join(format_raffle_delivery(rid, r) for rid, r in reversed(recent))
+    )
+
+
+@dp.message(Command("rebuildstats"))
+async def cmd_rebuildstats(m: types.Message):
+    register_user(m.from_user)
+    if m.from_user.id != MAIN_ADMIN_ID:
+        return await m.answer("⛔ Только основной админ.")
+    await rebuild_user_stats()
+    _history_cache.clear()
+    await m.answer("✅ Статистика игроков пересчитана по истории игр.")
+
+
+def format_memory_stats() -> str:
+    waiting = len(open_game_ids[0])
+    return (
+        f"игры: ждут соперника {waiting}, играются {len(games) - waiting}, "
+        f"недавние {len(recent_games)}/{RECENT_GAMES_CACHE_SIZE}\n"
+        f"таймеры игр: {len(_game_deadlines)} (в куче {len(_game_expiry_heap)})\n"
+        f"пользователи: {len(user_balances)}/{USER_CACHE_MAX_USERS}, "
+        f"не записано в БД {pending_user_updates()}\n"
+        f"кэш «Мои игры»: {len(_history_cache)}/{HISTORY_CACHE_SIZE}"
+    )
+
+
+@dp.message(Command("metrics"))
+async def cmd_metrics(m: types.Message):
+    register_user(m.from_user)
+    if not is_admin(m.from_user.id):
+        return await m.answer("⛔ Нет прав.")
+    await m.answer(
+        f"📊 Метрики\n\n"
+        f"🌐 HTTP:\n{format_http_stats()}\n\n"
+        f"💎 Пополнения TON: {ton_ingest_mode}, опрос каждые {ton_poll_interval:.0f} с\n"
+        f"{format_deposit_pipeline_stats()}\n\n"
+        f"📨 Исходящие сообщения:\n{format_outbox_stats()}\n\n"
+        f"🧠 Память:\n{format_memory_stats()}"
+    )
+
+
 # ========================
 #      ПОПОЛНЕНИЕ ЧЕРЕЗ TON
 # ========================
@@ -859,106 +1307,262 @@ async def cb_deposit_menu(callback: CallbackQuery):
     await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
     await callback.answer()
 
+    # пользователь вот-вот пришлёт TON — опрашиваем tonapi чаще
+    global _deposit_menu_shown_at
+    _deposit_menu_shown_at = time.monotonic()
+    _deposit_activity.set()
 
-async def ton_deposit_worker():
-    """Периодически опрашивает tonapi по адресу кошелька и ищет новые входящие переводы.
+
+def parse_ton_deposit(tx: dict) -> tuple[int, int, str] | None:
+    """Разобрать транзакцию tonapi: (user_id, сумма в nanoton, комментарий) или None.
 
     Для зачисления бот ищет в комментарии текст вида ID<user_id>, например ID123456789.
     Это значение мы просим пользователя указывать при пополнении.
     """
+    # пробуем вытащить комментарий (text) из разных полей
+    comment = ""
+    in_msg = tx.get("in_msg") or tx.get("in_message") or {}
+    if isinstance(in_msg, dict):
+        comment = in_msg.get("message") or ""
+        msg_data = in_msg.get("msg_data") or {}
+        if isinstance(msg_data, dict):
+            comment = msg_data.get("text") or comment
+
+    if not comment:
+        return None
+
+    # ищем ID<user_id>
+    m = re.search(r"ID(\d{5,15})", str(comment))
+    if not m:
+        return None
+
+    user_id = int(m.group(1))
+
+    # сумма перевода в nanotons, поле value может быть строкой
+    value_nanoton = 0
+    if isinstance(in_msg, dict):
+        v = in_msg.get("value")
+        if isinstance(v, str) and v.isdigit():
+            value_nanoton = int(v)
+        elif isinstance(v, int):
+            value_nanoton = v
+
+    if value_nanoton <= 0:
+        return None
+
+    return user_id, value_nanoton, str(comment)
+
+
+def _record_stage(stage: str, items: int, started: float):
+    stats = deposit_stage_stats[stage]
+    stats["items"] += items
+    stats["seconds"] += time.monotonic() - started
+
+
+async def deposit_credit_worker():
+    """Стадия зачисления: пачка пополнений пишется в БД одной транзакцией вместе с курсором."""
+    while True:
+        wallet, last_lt, deposits = await _deposit_credit_queue.get()
+        started = time.monotonic()
+        rate = await get_ton_rub_rate()
+        rows = []
+        for tx_hash, user_id, value_nanoton, comment in deposits:
+            ton_amount = value_nanoton / 1e9
+            coins = int(ton_amount * rate)
+            if coins > 0:
+                rows.append((tx_hash, user_id, ton_amount, coins, comment))
+
+        # зачисление пишется в той же транзакции, что и пополнения с курсором: нужны
+        # текущие балансы, и до конца записи получателей нельзя вытеснять из кэша —
+        # иначе их перечитают из БД уже с зачислением и зачислят второй раз
+        recipients = {row[1] for row in rows}
+        await _retry_until_ok(lambda: ensure_users(*recipients), "пополнения TON")
+        _pinned_users.update(recipients)
+        try:
+            # порядок пачек важен для курсора, поэтому при ошибке БД повторяем ту же пачку
+            # (идемпотентность — по первичному ключу ton_deposits)
+            inserted = await _retry_until_ok(lambda: add_ton_deposits(
+                wallet, last_lt, rows, {uid: get_balance(uid) for uid in recipients}
+            ), "пополнения TON")
+        finally:
+            _pinned_users.difference_update(recipients)
+        # без await после commit: следующий сброс кэша запишет уже этот баланс
+        for _tx_hash, user_id, _ton, coins, _comment in inserted:
+            change_balance(user_id, coins)
+        _record_stage("credit", len(deposits), started)
+        _deposit_credit_queue.task_done()
+
+        for _tx_hash, user_id, ton_amount, coins, comment in inserted:
+            await _deposit_notify_queue.put(
+                (user_id, ton_amount, coins, rate, comment, get_balance(user_id))
+            )
+
+
+async def deposit_notify_worker():
+    """Стадия уведомлений: передаёт сообщения в outbox, не задерживая зачисление."""
+    while True:
+        user_id, ton_amount, coins, rate, comment, balance = await _deposit_notify_queue.get()
+        started = time.monotonic()
+        queue_message(
+            user_id,
+            f"✅ Пополнение через TON успешно!\n\n"
+            f"Получено: {ton_amount:.4f} TON\n"
+            f"Курс: 1 TON ≈ {rate:.2f} монет (₽)\n"
+            f"Зачислено: {format_coins(coins)} монет\n"
+            f"Текущий баланс: {format_coins(balance)} монет.",
+            PRIORITY_GAME,
+        )
+        queue_message(
+            MAIN_ADMIN_ID,
+            f"💎 Новое пополнение через TON\n"
+            f"User ID: {user_id}\n"
+            f"Комментарий: {comment}\n"
+            f"Сумма: {ton_amount:.4f} TON ≈ {format_coins(coins)} монет",
+            PRIORITY_ADMIN,
+        )
+        _record_stage("notify", 1, started)
+        _deposit_notify_queue.task_done()
+
+
+def format_deposit_pipeline_stats() -> str:
+    lines = [
+        f"очередь на зачисление: {_deposit_credit_queue.qsize()}, "
+        f"на уведомление: {_deposit_notify_queue.qsize()}"
+    ]
+    for stage, s in deposit_stage_stats.items():
+        rate = s["items"] / s["seconds"] if s["seconds"] else 0.0
+        lines.append(f"{stage}: {int(s['items'])} шт., {rate:.0f}/с")
+    return "\n".join(lines)
+
+
+async def fetch_ton_transactions_since(wallet: str, cursor: int) -> list[dict]:
+    """Все транзакции кошелька новее курсора, от старых к новым.
+
+    tonapi отдаёт страницы от новых к старым, поэтому листаем назад через before_lt,
+    пока не дойдём до курсора. Без курсора (первый запуск) берём только первую страницу,
+    чтобы не выкачивать всю историю кошелька.
+    """
+    url = f"{TONAPI_BASE_URL}/blockchain/accounts/{wallet}/transactions"
+    collected: list[dict] = []
+    before_lt = None
+
+    while True:
+        params = {"limit": TON_TX_PAGE_SIZE}
+        if before_lt is not None:
+            params["before_lt"] = before_lt
+        data = await get_json("tonapi", url, params)
+
+        page = data.get("transactions") or data.get("data") or []
+        fresh = [tx for tx in page if int(tx.get("lt") or 0) > cursor]
+        collected.extend(fresh)
+
+        if not cursor or len(fresh) < len(page) or len(page) < TON_TX_PAGE_SIZE:
+            break
+        before_lt = min(int(tx["lt"]) for tx in page)
+
+    # на границах страниц одна транзакция может прийти дважды
+    unique = {int(tx["lt"]): tx for tx in collected}
+    return [unique[lt] for lt in sorted(unique)]
+
+
+async def poll_ton_deposits(wallet: str = TON_WALLET_ADDRESS):
+    """Один проход: догнать все транзакции кошелька, появившиеся после курсора.
+
+    Курсор — logical time (lt) последней обработанной транзакции, хранится в БД,
+    поэтому ни при старте, ни в памяти не нужно держать все хэши пополнений.
+    Здесь только стадия разбора: пачки от старых к новым уходят в очередь
+    deposit_credit_worker, который и сдвигает курсор.
+    """
+    cursor = max(await get_ton_cursor(wallet), _ton_enqueued_lt.get(wallet, 0))
+
+    fresh = await fetch_ton_transactions_since(wallet, cursor)
+
+    for i in range(0, len(fresh), TON_CATCHUP_BATCH_SIZE):
+        batch = fresh[i:i + TON_CATCHUP_BATCH_SIZE]
+        started = time.monotonic()
+        deposits = []
+        for tx in batch:
+            tx_hash = tx.get("hash") or tx.get("transaction_id") or ""
+            deposit = parse_ton_deposit(tx) if tx_hash else None
+            if deposit:
+                deposits.append((tx_hash, *deposit))
+        _record_stage("parse", len(batch), started)
+
+        last_lt = int(batch[-1]["lt"])
+        await _deposit_credit_queue.put((wallet, last_lt, deposits))
+        _ton_enqueued_lt[wallet] = last_lt
+
+
+def next_ton_poll_interval(errors: int) -> float:
+    """Интервал до следующего опроса TON.
+
+    Часто — пока недавно показывали адрес пополнения, редко — в простое;
+    при ошибках подряд интервал растёт экспоненциально.
+    """
+    if time.monotonic() - _deposit_menu_shown_at < TON_POLL_FAST_WINDOW:
+        interval = TON_POLL_FAST_INTERVAL
+    else:
+        interval = TON_POLL_IDLE_INTERVAL
+    if errors:
+        interval = min(interval * 2 ** errors, TON_POLL_MAX_BACKOFF)
+    return interval
+
+
+async def run_ton_stream(wallet: str = TON_WALLET_ADDRESS):
+    """Держать SSE-подписку на транзакции кошелька, пока поток жив.
+
+    Событие несёт только lt/хэш, поэтому на каждое событие догоняем курсор через
+    poll_ton_deposits: так же идемпотентно и без пропусков между событиями.
+    """
+    global ton_ingest_mode
+    url = f"{TONAPI_BASE_URL}/sse/accounts/transactions"
+    events = stream_sse("tonapi", url, {"accounts": wallet})
+    try:
+        # сначала догоняем всё, что пришло, пока потока не было
+        await poll_ton_deposits(wallet)
+        ton_ingest_mode = "streaming"
+        async for _event in events:
+            await poll_ton_deposits(wallet)
+    finally:
+        ton_ingest_mode = "polling"
+        await events.aclose()
+
+
+async def ton_deposit_worker():
+    """Ищет новые входящие переводы на кошелёк: SSE-поток (если включён) или опрос tonapi."""
+    global ton_poll_interval
     if not TON_WALLET_ADDRESS:
         print("TON_WALLET_ADDRESS не задан, ton_deposit_worker не запускается.")
         return
 
-    url = f"https://tonapi.io/v2/blockchain/accounts/{TON_WALLET_ADDRESS}/transactions?limit=50"
-
+    errors = 0
+    stream_retry_at = 0.0
     while True:
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=10) as resp:
-                    data = await resp.json()
-
-            tx_list = data.get("transactions") or data.get("data") or []
-
-            for tx in tx_list:
-                tx_hash = tx.get("hash") or tx.get("transaction_id") or ""
-                if not tx_hash or tx_hash in processed_ton_tx:
-                    continue
-
-                # пробуем вытащить комментарий (text) из разных полей
-                comment = ""
-                in_msg = tx.get("in_msg") or tx.get("in_message") or {}
-                if isinstance(in_msg, dict):
-                    comment = in_msg.get("message") or ""
-                    msg_data = in_msg.get("msg_data") or {}
-                    if isinstance(msg_data, dict):
-                        comment = msg_data.get("text") or comment
-
-                if not comment:
-                    processed_ton_tx.add(tx_hash)
-                    continue
-
-                # ищем ID<user_id>
-                m = re.search(r"ID(\d{5,15})", str(comment))
-                if not m:
-                    processed_ton_tx.add(tx_hash)
-                    continue
-
-                user_id = int(m.group(1))
-
-                # сумма перевода в nanotons, поле value может быть строкой
-                value_nanoton = 0
-                if isinstance(in_msg, dict):
-                    v = in_msg.get("value")
-                    if isinstance(v, str) and v.isdigit():
-                        value_nanoton = int(v)
-                    elif isinstance(v, int):
-                        value_nanoton = v
-
-                if value_nanoton <= 0:
-                    processed_ton_tx.add(tx_hash)
-                    continue
-
-                ton_amount = value_nanoton / 1e9
-                rate = await get_ton_rub_rate()
-                coins = int(ton_amount * rate)
-
-                if coins <= 0:
-                    processed_ton_tx.add(tx_hash)
-                    continue
-
-                change_balance(user_id, coins)
-                processed_ton_tx.add(tx_hash)
-
-                await add_ton_deposit(tx_hash, user_id, ton_amount, coins, comment)
-
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"✅ Пополнение через TON успешно!\n\n"
-                        f"Получено: {ton_amount:.4f} TON\n"
-                        f"Курс: 1 TON ≈ {rate:.2f} монет (₽)\n"
-                        f"Зачислено: {format_coins(coins)} монет\n"
-                        f"Текущий баланс: {format_coins(get_balance(user_id))} монет."
-                    )
-                except Exception:
-                    pass
-
-                try:
-                    await bot.send_message(
-                        MAIN_ADMIN_ID,
-                        f"💎 Новое пополнение через TON\n"
-                        f"User ID: {user_id}\n"
-                        f"Комментарий: {comment}\n"
-                        f"Сумма: {ton_amount:.4f} TON ≈ {format_coins(coins)} монет"
-                    )
-                except Exception:
-                    pass
+        if TON_DEPOSIT_STREAMING and time.monotonic() >= stream_retry_at:
+            try:
+                await run_ton_stream()
+            except Exception as e:
+                print("Поток транзакций TON оборвался:", e)
+            # до переподключения работаем опросом, курсор догонит пропущенное
+            stream_retry_at = time.monotonic() + TON_STREAM_RETRY_DELAY
 
+        try:
+            await poll_ton_deposits()
+            errors = 0
         except Exception as e:
+            errors += 1
             print("Ошибка в ton_deposit_worker:", e)
 
-        await asyncio.sleep(20)
+        ton_poll_interval = next_ton_poll_interval(errors)
+        _deposit_activity.clear()
+        if errors:
+            await asyncio.sleep(ton_poll_interval)
+            continue
+        try:
+            # открытие меню пополнения будит опрос сразу
+            await asyncio.wait_for(_deposit_activity.wait(), timeout=ton_poll_interval)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ========================
@@ -1004,12 +1608,13 @@ async def cb_transfer_menu(callback: CallbackQuery):
     await callback.answer()
 
 
-def resolve_user_by_username(username_str: str) -> int | None:
+async def resolve_user_by_username(username_str: str) -> int | None:
     uname = username_str.strip().lstrip("@").lower()
+    # в кэше могут быть ещё не записанные в БД username
     for uid, uname_stored in user_usernames.items():
         if uname_stored and uname_stored.lower() == uname:
             return uid
-    return None
+    return await find_user_by_username(uname)
 
 
 # ========================
@@ -1063,7 +1668,7 @@ async def cb_raffle_quick(callback: CallbackQuery):
     uid = callback.from_user.id
     amount = int(callback.data.split(":", 1)[1])
     try:
-        total, user_bet, chance = await place_raffle_bet(uid, amount)
+        room, total, user_bet, chance = await place_raffle_bet(uid, amount)
     except ValueError as e:
         await callback.message.answer(str(e))
         await callback.answer()
@@ -1074,7 +1679,7 @@ async def cb_raffle_quick(callback: CallbackQuery):
         return
 
     await callback.message.answer(
-        f"✅ Ставка в розыгрыше принята!\n"
+        f"✅ Ставка в розыгрыше принята ({RAFFLE_ROOMS[room][0]})!\n"
         f"Ваша общая ставка: {format_coins(user_bet)} монет\n"
         f"Общий банк: {format_coins(total)} монет\n"
         f"Ваш шанс: {chance:.1f}%"
@@ -1119,7 +1724,7 @@ async def process_text(m: types.Message):
         bet = int(text)
         if bet < DICE_MIN_BET:
             return await m.answer(f"Минимальная ставка {DICE_MIN_BET} монет.")
-        if bet > get_balance(uid):
+        if not debit_if_sufficient(uid, bet):
             return await m.answer("Недостаточно монет на балансе!")
 
         global next_game_id
@@ -1137,15 +1742,27 @@ async def process_text(m: types.Message):
             "finished": False,
             "created_at": datetime.now(UTC),
             "finished_at": None,
+            "roll_engine": DICE_ROLL_ENGINE,
+            "server_seed": None,
+            "seed_hash": None,
+            "client_seed": None,
         }
+        if DICE_ROLL_ENGINE == "server":
+            # хэш сида показываем сразу, сам сид — только после игры
+            games[gid]["server_seed"] = new_server_seed()
+            games[gid]["seed_hash"] = seed_hash(games[gid]["server_seed"])
 
-        change_balance(uid, -bet)
         pending_bet_input.pop(uid)
+        index_open_game(games[gid])
+        schedule_game_expiry(gid)
 
-        # сохраняем игру в БД
-        await upsert_game(games[gid])
+        # сохраняем игру в БД вместе со списанной ставкой
+        await upsert_game(games[gid], (uid,))
 
-        await m.answer(f"✅ Игра №{gid} создана!")
+        created_text = f"✅ Игра №{gid} создана!"
+        if games[gid]["seed_hash"]:
+            created_text += f"\n🔐 Хэш сида: {games[gid]['seed_hash']}"
+        await m.answer(created_text)
         return await send_games_list(m.chat.id, uid)
 
     # 2) вывод — шаг суммы
@@ -1198,10 +1815,7 @@ async def process_text(m: types.Message):
             f"После фактической отправки TON уменьшите баланс через /removebalance или /setbalance."
         )
         for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(admin_id, msg_admin)
-            except Exception:
-                pass
+            queue_message(admin_id, msg_admin, PRIORITY_ADMIN)
 
         await m.answer(
             "✅ Заявка на вывод отправлена администратору.\n"
@@ -1216,11 +1830,11 @@ async def process_text(m: types.Message):
     if pending_transfer_step.get(uid) == "target":
         target_id: int | None = None
         if text.startswith("@"):
-            target_id = resolve_user_by_username(text)
+            target_id = await resolve_user_by_username(text)
         elif text.isdigit():
             target_id = int(text)
         else:
-            target_id = resolve_user_by_username(text)
+            target_id = await resolve_user_by_username(text)
 
         if not target_id:
             return await m.answer(
@@ -1243,9 +1857,6 @@ async def process_text(m: types.Message):
         amount = int(text)
         if amount <= 0:
             return await m.answer("Сумма должна быть > 0.")
-        bal = get_balance(uid)
-        if amount > bal:
-            return await m.answer(f"Недостаточно монет. Ваш баланс: {bal}.")
 
         target_id = temp_transfer[uid].get("target_id")
         if not target_id:
@@ -1253,27 +1864,26 @@ async def process_text(m: types.Message):
             temp_transfer.pop(uid, None)
             return await m.answer("Ошибка: не найден получатель, попробуйте ещё раз.")
 
-        change_balance(uid, -amount)
-        change_balance(target_id, amount)
-
-        await add_transfer(uid, target_id, amount)
+        async with user_locks(uid, target_id):
+            await ensure_users(uid, target_id)
+            if not transfer_balance(uid, target_id, amount):
+                return await m.answer(f"Недостаточно монет. Ваш баланс: {get_balance(uid)}.")
+            # деньги уже переведены в памяти: повторный ввод суммы не должен перевести их ещё раз
+            pending_transfer_step.pop(uid, None)
+            temp_transfer.pop(uid, None)
+            await _retry_until_ok(lambda: add_transfer(uid, target_id, amount), "перевод")
 
         await m.answer(
             f"✅ Перевод выполнен.\n"
             f"Вы отправили {format_coins(amount)} монет пользователю ID {target_id}.\n"
             f"Ваш новый баланс: {get_balance(uid)} монет."
         )
-        try:
-            await bot.send_message(
-                target_id,
-                f"🔄 Вам перевели {format_coins(amount)} монет от пользователя ID {uid}.\n"
-                f"Ваш новый баланс: {get_balance(target_id)} монет."
-            )
-        except Exception:
-            pass
-
-        pending_transfer_step.pop(uid, None)
-        temp_transfer.pop(uid, None)
+        queue_message(
+            target_id,
+            f"🔄 Вам перевели {format_coins(amount)} монет от пользователя ID {uid}.\n"
+            f"Ваш новый баланс: {get_balance(target_id)} монет.",
+            PRIORITY_NORMAL,
+        )
         return
 
     # 6) ввод суммы ставки для розыгрыша
@@ -1282,7 +1892,7 @@ async def process_text(m: types.Message):
             return await m.answer("Введите сумму числом:")
         amount = int(text)
         try:
-            total, user_bet, chance = await place_raffle_bet(uid, amount)
+            room, total, user_bet, chance = await place_raffle_bet(uid, amount)
         except ValueError as e:
             return await m.answer(str(e))
         except RuntimeError as e:
@@ -1291,7 +1901,7 @@ async def process_text(m: types.Message):
         pending_raffle_bet_input.pop(uid, None)
 
         return await m.answer(
-            f"✅ Ставка в розыгрыше принята!\n"
+            f"✅ Ставка в розыгрыше принята ({RAFFLE_ROOMS[room][0]})!\n"
             f"Ваша общая ставка: {format_coins(user_bet)} монет\n"
             f"Общий банк: {format_coins(total)} монет\n"
             f"Ваш шанс: {chance:.1f}%"
@@ -1310,6 +1920,8 @@ async def cb_game_open(callback: CallbackQuery):
     g = games.get(gid)
 
     if not g:
+        if gid in recent_games:
+            return await callback.answer("Игра уже сыграна.", show_alert=True)
         return await callback.answer("Игра не найдена.", show_alert=True)
     if g["opponent_id"] is not None:
         return await callback.answer("Кто-то уже вступил!", show_alert=True)
@@ -1321,9 +1933,11 @@ async def cb_game_open(callback: CallbackQuery):
         ]
     )
 
+    fair_text = f"🔐 Хэш сида: {g['seed_hash']}\n\n" if g.get("seed_hash") else ""
     await callback.message.answer(
         f"🎲 Игра №{gid}\n"
         f"💰 Ставка: {format_coins(g['bet'])} монет\n\n"
+        f"{fair_text}"
         f"Хотите вступить?",
         reply_markup=kb
     )
@@ -1381,8 +1995,12 @@ async def cb_cancel_game(callback: CallbackQuery):
         return await callback.answer("Уже есть соперник.", show_alert=True)
 
     bet = g["bet"]
+    cancel_game_expiry(gid)
+    unindex_open_game(g)
     change_balance(uid, bet)
     del games[gid]
+    # без повтора строка игры пережила бы ошибку, и после рестарта ставку вернули бы ещё раз
+    await _retry_until_ok(lambda: delete_game(gid, (uid,)), "отмена игры")
 
     await callback.message.answer(
         f"❌ Ставка №{gid} отменена. {format_coins(bet)} монет возвращены на баланс."
@@ -1402,24 +2020,35 @@ async def cb_join_confirm(callback: CallbackQuery):
 
     g = games.get(gid)
     if not g:
+        if gid in recent_games:
+            return await callback.answer("Игра уже сыграна.", show_alert=True)
         return await callback.answer("Игра не найдена.", show_alert=True)
     if g["opponent_id"] is not None:
         return await callback.answer("Кто-то уже вступил!", show_alert=True)
 
+    if g["creator_id"] == uid:
+        return await callback.answer("Это ваша игра.", show_alert=True)
+
     bet = g["bet"]
-    if get_balance(uid) < bet:
+    if not debit_if_sufficient(uid, bet):
         return await callback.answer("Недостаточно монет.", show_alert=True)
 
+    # соперник закреплён до первого await: второй вступающий увидит занятую игру
     g["opponent_id"] = uid
-    change_balance(uid, -bet)
+    if g.get("roll_engine") == "server":
+        # сид соперника — id нажатия «Вступить» от Telegram: при создании игры его не знал никто
+        g["client_seed"] = callback.id
+    cancel_game_expiry(gid)
+    unindex_open_game(g)
 
-    # обновляем игру в БД (добавился соперник)
-    await upsert_game(g)
+    # обновляем игру в БД (добавился соперник) вместе со списанной ставкой; соперник уже
+    # закреплён и списан в памяти, поэтому повторяем до успеха — иначе игра зависла бы в games
+    await _retry_until_ok(lambda: upsert_game(g, (uid,)), "вступление в игру")
 
     await callback.message.answer(f"✅ Вы присоединились к игре №{gid}!")
     await callback.answer()
 
-    await play_game(gid)
+    start_game(gid)
 
 
 # ========================
@@ -1431,7 +2060,7 @@ async def cb_my_games(callback: CallbackQuery):
     uid = callback.from_user.id
     page = int(callback.data.split(":", 1)[1])
 
-    stats, history = await build_user_stats_and_history(uid)
+    stats, history = await get_user_stats_and_history(uid)
     kb = build_history_keyboard(history, page)
 
     await callback.message.answer(stats, reply_markup=kb)
@@ -1442,22 +2071,39 @@ async def cb_my_games(callback: CallbackQuery):
 #      ОБНОВИТЬ СПИСОК ИГР
 # ========================
 
-@dp.callback_query(F.data == "refresh_games")
-async def cb_refresh_games(callback: CallbackQuery):
+async def _show_games_page(callback: CallbackQuery, tier: int, page: int):
     uid = callback.from_user.id
+    if not 0 <= tier < len(GAMES_STAKE_TIERS):
+        tier = 0
     try:
         await callback.message.edit_text(
             build_games_text(),
-            reply_markup=build_games_keyboard(uid)
+            reply_markup=build_games_keyboard(uid, tier, page)
         )
     except Exception:
         await callback.message.answer(
             build_games_text(),
-            reply_markup=build_games_keyboard(uid)
+            reply_markup=build_games_keyboard(uid, tier, page)
         )
+
+
+@dp.callback_query(F.data.startswith("refresh_games"))
+async def cb_refresh_games(callback: CallbackQuery):
+    # refresh_games:<фильтр>:<страница>; у старых кнопок без параметров — первая страница
+    parts = callback.data.split(":")
+    tier = int(parts[1]) if len(parts) > 2 else 0
+    page = int(parts[2]) if len(parts) > 2 else 0
+    await _show_games_page(callback, tier, page)
     await callback.answer("Обновлено!")
 
 
+@dp.callback_query(F.data.startswith("games_page:"))
+async def cb_games_page(callback: CallbackQuery):
+    _, tier, page = callback.data.split(":")
+    await _show_games_page(callback, int(tier), int(page))
+    await callback.answer()
+
+
 # ========================
 #      РЕЙТИНГ
 # ========================
@@ -1508,13 +2154,92 @@ async def cb_ignore(callback: CallbackQuery):
 #      ЗАПУСК БОТА
 # ========================
 
+async def restore_state(state: dict):
+    """Тёплый рестарт: вернуть в память незавершённые игры и розыгрыши (из init_db).
+
+    Таймеры игр продолжаются с того же дедлайна, игры с соперником доигрываются,
+    розыгрыши с 2+ участниками получают новый таймер.
+    """
+    global next_game_id, next_raffle_id
+    next_game_id = state["next_game_id"]
+    next_raffle_id = state["next_raffle_id"]
+
+    now = time.time()
+    for row in state["games"]:
+        gid = row["id"]
+        g = {
+            "id": gid,
+            "creator_id": row["creator_id"],
+            "opponent_id": row["opponent_id"],
+            "bet": row["bet"],
+            "creator_roll": None,
+            "opponent_roll": None,
+            "winner": None,
+            "finished": False,
+            "created_at": datetime.fromisoformat(row["created_at"]),
+            "finished_at": None,
+            "roll_engine": row["roll_engine"] or "telegram",
+            "server_seed": row["server_seed"],
+            "client_seed": row["client_seed"],
+            "seed_hash": row["seed_hash"],
+        }
+        games[gid] = g
+        if g["opponent_id"] is None:
+            index_open_game(g)
+            age = now - g["created_at"].timestamp()
+            schedule_game_expiry(gid, max(0.0, GAME_TTL_SECONDS - age))
+        else:
+            # соперник вступил, но результат не успели записать
+            start_game(gid)
+
+    for row in state["raffle_rounds"]:
+        room = row["room"]
+        raffle_round = new_raffle_round(row["id"], room)
+        raffle_round["created_at"] = datetime.fromisoformat(row["created_at"])
+        for uid, amount in row["bets"]:
+            raffle_add_bet(raffle_round, uid, amount)
+
+        # в комнате может быть только один раунд: более старый закрываем с возвратом ставок
+        stale = raffle_rounds.get(room)
+        if stale is not None:
+            await ensure_users(*stale["bets"])
+            for uid, amount in stale["bets"].items():
+                change_balance(uid, amount)
+            stale["finished_at"] = datetime.now(UTC)
+            await upsert_raffle_round(stale, stale["bets"])
+        raffle_rounds[room] = raffle_round
+
+    for room, raffle_round in raffle_rounds.items():
+        if len(raffle_round["bets"]) >= 2:
+            await schedule_raffle_draw(room)
+
+    if state["games"] or state["raffle_rounds"]:
+        print(
+            f"Восстановлено: игр {len(state['games'])}, "
+            f"розыгрышей {len(state['raffle_rounds'])}."
+        )
+
+
 async def main():
     print("Бот запущен (TON + Кости + Банкир + переводы, SQLite).")
     # инициализация БД и загрузка данных
-    await init_db(user_balances, user_usernames, processed_ton_tx)
-    asyncio.create_task(cleanup_worker())
+    state = await init_db()
+    start_outbox(bot)
+    await restore_state(state)
+    asyncio.create_task(game_expiry_worker())
+    asyncio.create_task(ton_rate_worker())
+    asyncio.create_task(deposit_credit_worker())
+    asyncio.create_task(deposit_notify_worker())
     asyncio.create_task(ton_deposit_worker())
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # доигрываем уже начатые дуэли, чтобы ставки не повисли
+        if _game_tasks:
+            await asyncio.wait(_game_tasks, timeout=DICE_ANIMATION_SECONDS + 10)
+        await close_outbox()
+        await close_http()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -1,17 +1,108 @@
-import aiosqlite
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, UTC
-from typing import Dict, Set, List, Any
+from typing import AsyncIterator, Dict, Iterable, List, Any
+
+import aiosqlite
 
 DB_PATH = "database.db"
+DB_READ_POOL_SIZE = 3  # сколько read-only соединений держать открытыми
 
+# Долгоживущие соединения: одно на запись + небольшой пул на чтение.
+# Открываются в init_db и живут до close_db (вызывается из main при остановке).
+_writer: aiosqlite.Connection | None = None
+_write_lock = asyncio.Lock()
+_readers: list[aiosqlite.Connection] = []
+_read_pool: asyncio.Queue | None = None
 
-async def init_db(
-    user_balances: Dict[int, int],
-    user_usernames: Dict[int, str],
-    processed_ton_tx: Set[str],
-):
-    """Инициализация SQLite, создание таблиц и загрузка данных в память."""
-    async with aiosqlite.connect(DB_PATH) as db:
+# Отложенная запись пользователей: uid -> {колонка: значение}.
+# Повторные изменения одного uid склеиваются, пишутся только изменённые колонки.
+USER_FLUSH_INTERVAL = 1.0      # секунд между сбросами
+USER_FLUSH_BATCH_SIZE = 500    # сбросить раньше, если накопилось столько пользователей
+_USER_COLUMNS = ("username", "balance")
+_UNSET = object()
+_pending_users: dict[int, dict[str, Any]] = {}
+_flushing_users: set[int] = set()  # uid из батча, который сейчас пишется
+_reserved_users: dict[int, int] = {}  # uid -> сколько _write_with_users ждут замка записи
+_flush_wakeup = asyncio.Event()
+_flusher_stopping = False  # close_db просит воркер доделать текущий сброс и выйти
+_user_flusher_task: asyncio.Task | None = None
+
+# Корзины статистики «Мои игры»: часовые храним чуть дольше самого длинного окна (месяц)
+HOUR_SECONDS = 3600
+DAY_SECONDS = 86400
+HOURLY_BUCKETS_KEEP_SECONDS = 32 * DAY_SECONDS
+
+
+@asynccontextmanager
+async def _write() -> AsyncIterator[aiosqlite.Connection]:
+    """Эксклюзивный доступ к пишущему соединению: commit при выходе, rollback при ошибке."""
+    if _writer is None:
+        raise RuntimeError("БД не инициализирована, сначала вызовите init_db()")
+    async with _write_lock:
+        try:
+            yield _writer
+        except BaseException:
+            await _writer.rollback()
+            raise
+        await _writer.commit()
+
+
+@asynccontextmanager
+async def _read() -> AsyncIterator[aiosqlite.Connection]:
+    """Взять read-only соединение из пула (строки приходят как aiosqlite.Row)."""
+    if _read_pool is None:
+        raise RuntimeError("БД не инициализирована, сначала вызовите init_db()")
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+async def _open_readers():
+    global _read_pool
+    _read_pool = asyncio.Queue()
+    for _ in range(DB_READ_POOL_SIZE):
+        conn = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+        conn.row_factory = aiosqlite.Row
+        _readers.append(conn)
+        _read_pool.put_nowait(conn)
+
+
+async def close_db():
+    """Сбросить отложенные записи и закрыть все соединения с БД (при остановке бота)."""
+    global _writer, _read_pool, _user_flusher_task, _flusher_stopping
+    if _user_flusher_task is not None:
+        # не отменяем воркер: отмена посреди сброса откатила бы транзакцию
+        _flusher_stopping = True
+        _flush_wakeup.set()
+        await _user_flusher_task
+        _user_flusher_task = None
+        _flusher_stopping = False
+    if _writer is not None:
+        await flush_users()
+    for conn in _readers:
+        await conn.close()
+    _readers.clear()
+    _read_pool = None
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+
+async def init_db() -> Dict[str, Any]:
+    """Инициализация SQLite: соединения, создание таблиц и миграции.
+
+    Открывает долгоживущие соединения, которыми дальше пользуются все функции модуля.
+    Пользователи в память не грузятся — см. load_users.
+    Возвращает состояние для тёплого рестарта — см. _load_state.
+    """
+    global _writer, _user_flusher_task
+    if _writer is None:
+        _writer = await aiosqlite.connect(DB_PATH)
+
+    async with _write() as db:
         await db.executescript(
             """
             PRAGMA journal_mode = WAL;
@@ -70,123 +161,676 @@ async def init_db(
             );
             """
         )
-        await db.commit()
+        await _migrate(db)
 
-        # Загружаем пользователей в память
-        async with db.execute("SELECT id, username, balance FROM users") as cur:
-            rows = await cur.fetchall()
-            for uid, uname, bal in rows:
-                user_balances[int(uid)] = int(bal)
-                if uname:
-                    user_usernames[int(uid)] = uname
+    if _read_pool is None:
+        await _open_readers()
 
-        # Загружаем уже обработанные TON-транзакции
-        async with db.execute("SELECT tx_hash FROM ton_deposits") as cur:
-            rows = await cur.fetchall()
-            for (tx_hash,) in rows:
-                processed_ton_tx.add(tx_hash)
+    if _user_flusher_task is None:
+        _user_flusher_task = asyncio.create_task(_user_flush_worker())
 
+    return await _load_state()
 
-async def upsert_user(user_id: int, username: str | None, balance: int):
-    """Создать/обновить пользователя и баланс."""
-    reg_date = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+
+async def _load_state() -> Dict[str, Any]:
+    """Незавершённые игры и розыгрыши и следующие id — всё по индексам.
+
+    {"next_game_id", "next_raffle_id", "games": [строки games],
+     "raffle_rounds": [строки raffle_rounds + "bets": [(user_id, amount), ...]]}
+    """
+    async with _read() as db:
+        async with db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM games") as cur:
+            (next_game_id,) = await cur.fetchone()
+        async with db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM raffle_rounds") as cur:
+            (next_raffle_id,) = await cur.fetchone()
+        async with db.execute(
+            "SELECT * FROM games WHERE finished = 0 AND abandoned = 0 ORDER BY id"
+        ) as cur:
+            games = [dict(row) for row in await cur.fetchall()]
+        async with db.execute(
+            "SELECT * FROM raffle_rounds WHERE finished_at IS NULL ORDER BY id"
+        ) as cur:
+            rounds = [dict(row) for row in await cur.fetchall()]
+        for r in rounds:
+            async with db.execute(
+                "SELECT user_id, amount FROM raffle_bets WHERE round_id = ? ORDER BY id",
+                (r["id"],),
+            ) as cur:
+                r["bets"] = [tuple(row) for row in await cur.fetchall()]
+    return {
+        "next_game_id": next_game_id,
+        "next_raffle_id": next_raffle_id,
+        "games": games,
+        "raffle_rounds": rounds,
+    }
+
+
+async def _migration_games_epoch(db: aiosqlite.Connection):
+    """Время игр в целых секундах epoch + частичные индексы для истории игрока."""
+    await db.execute("ALTER TABLE games ADD COLUMN created_ts INTEGER")
+    await db.execute("ALTER TABLE games ADD COLUMN finished_ts INTEGER")
+    await db.execute(
+        """
+        UPDATE games SET
+            created_ts = CAST(strftime('%s', created_at) AS INTEGER),
+            finished_ts = CAST(strftime('%s', finished_at) AS INTEGER)
+        """
+    )
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_games_creator_finished
+        ON games (creator_id, finished_ts) WHERE finished = 1
+        """
+    )
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_games_opponent_finished
+        ON games (opponent_id, finished_ts) WHERE finished = 1
+        """
+    )
+
+
+# Профит каждого участника каждой завершённой игры (то же, что calculate_profit в bot.py)
+_GAME_PROFITS_SQL = """
+    SELECT creator_id AS uid, finished_ts AS ts,
+           CASE winner WHEN 'draw' THEN 0 WHEN 'creator' THEN bet ELSE -bet END AS p
+    FROM games WHERE finished = 1
+    UNION ALL
+    SELECT opponent_id AS uid, finished_ts AS ts,
+           CASE winner WHEN 'draw' THEN 0 WHEN 'opponent' THEN bet ELSE -bet END AS p
+    FROM games WHERE finished = 1
+"""
+
+
+async def _rebuild_user_stats(db: aiosqlite.Connection):
+    await db.execute("DELETE FROM user_stats")
+    await db.execute(
+        f"""
+        INSERT INTO user_stats (user_id, profit, games, wins)
+        SELECT uid, SUM(p), COUNT(*), SUM(p > 0)
+        FROM ({_GAME_PROFITS_SQL})
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        """
+    )
+
+
+async def _rebuild_user_buckets(db: aiosqlite.Connection):
+    for table, col, size in (
+        ("user_stats_hourly", "hour_ts", HOUR_SECONDS),
+        ("user_stats_daily", "day_ts", DAY_SECONDS),
+    ):
+        await db.execute(f"DELETE FROM {table}")
         await db.execute(
+            f"""
+            INSERT INTO {table} (user_id, {col}, games, profit)
+            SELECT uid, ts / {size} * {size} AS bucket, COUNT(*), SUM(p)
+            FROM ({_GAME_PROFITS_SQL})
+            WHERE uid IS NOT NULL AND ts IS NOT NULL
+            GROUP BY uid, bucket
             """
-            INSERT INTO users (id, username, balance, reg_date)
-            VALUES (?, ?, ?, ?)
+        )
+
+    # часовые корзины нужны только для края самого длинного окна
+    cutoff = int(datetime.now(UTC).timestamp()) - HOURLY_BUCKETS_KEEP_SECONDS
+    await db.execute("DELETE FROM user_stats_hourly WHERE hour_ts < ?", (cutoff,))
+
+
+async def _migration_user_stats(db: aiosqlite.Connection):
+    """Агрегаты по игрокам для рейтинга, обновляются при расчёте каждой игры."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            profit INTEGER NOT NULL DEFAULT 0,
+            games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_stats_profit ON user_stats (profit DESC)"
+    )
+    await _rebuild_user_stats(db)
+
+
+async def _migration_user_buckets(db: aiosqlite.Connection):
+    """Часовые/суточные корзины игр и профита по игрокам для окон «сутки/неделя/месяц»."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_stats_hourly (
+            user_id INTEGER NOT NULL,
+            hour_ts INTEGER NOT NULL,
+            games INTEGER NOT NULL DEFAULT 0,
+            profit INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, hour_ts)
+        ) WITHOUT ROWID
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_stats_daily (
+            user_id INTEGER NOT NULL,
+            day_ts INTEGER NOT NULL,
+            games INTEGER NOT NULL DEFAULT 0,
+            profit INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day_ts)
+        ) WITHOUT ROWID
+        """
+    )
+    await _rebuild_user_buckets(db)
+
+
+async def _migration_users_username(db: aiosqlite.Connection):
+    """Поиск получателя перевода по @username без загрузки всех пользователей."""
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)"
+    )
+
+
+async def _migration_ton_cursors(db: aiosqlite.Connection):
+    """Курсор (logical time) обработанных TON-транзакций по каждому кошельку."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ton_cursors (
+            wallet TEXT PRIMARY KEY,
+            lt INTEGER NOT NULL
+        )
+        """
+    )
+
+
+async def _migration_games_fair_rolls(db: aiosqlite.Connection):
+    """Движок бросков игры и commit-reveal сид для честных серверных бросков."""
+    await db.execute("ALTER TABLE games ADD COLUMN roll_engine TEXT")
+    await db.execute("ALTER TABLE games ADD COLUMN seed_hash TEXT")
+    await db.execute("ALTER TABLE games ADD COLUMN server_seed TEXT")
+
+
+async def _migration_raffle_rooms(db: aiosqlite.Connection):
+    """Комната (уровень ставок) розыгрыша: несколько раундов идут одновременно."""
+    await db.execute("ALTER TABLE raffle_rounds ADD COLUMN room INTEGER NOT NULL DEFAULT 0")
+
+
+async def _migration_open_state(db: aiosqlite.Connection):
+    """Индексы для восстановления незавершённых игр и розыгрышей при старте.
+
+    Старые незавершённые строки не восстанавливаем: отменённые и удалённые по таймеру
+    игры раньше оставались в таблице, а id игр и розыгрышей повторялись после рестарта.
+    Их не удаляем, а помечаем abandoned = 1 и печатаем, чьи ставки в них остались
+    (см. _report_abandoned_stakes): вернуть их вручную может только админ.
+    """
+    now = datetime.now(UTC)
+    await db.execute("ALTER TABLE games ADD COLUMN abandoned INTEGER NOT NULL DEFAULT 0")
+    await db.execute(
+        "ALTER TABLE raffle_rounds ADD COLUMN abandoned INTEGER NOT NULL DEFAULT 0"
+    )
+    await db.execute(
+        "UPDATE games SET abandoned = 1, finished_at = ?, finished_ts = ? WHERE finished = 0",
+        (now.isoformat(), int(now.timestamp())),
+    )
+    await db.execute(
+        "UPDATE raffle_rounds SET abandoned = 1, finished_at = ? WHERE finished_at IS NULL",
+        (now.isoformat(),),
+    )
+    await _report_abandoned_stakes(db)
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_games_open
+        ON games(id) WHERE finished = 0 AND abandoned = 0
+        """
+    )
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_raffle_rounds_open
+        ON raffle_rounds(id) WHERE finished_at IS NULL
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_raffle_bets_round ON raffle_bets(round_id)"
+    )
+
+
+async def _report_abandoned_stakes(db: aiosqlite.Connection, top: int = 20):
+    """Напечатать ставки в строках, помеченных abandoned.
+
+    Точно не возвращены только ставки игр с соперником (вступившую игру нельзя было
+    отменить) и ставки незакрытых розыгрышей. Игры без соперника — статус неизвестен:
+    отменённые и удалённые по таймеру тоже оставались в таблице, но ставка по ним
+    уже вернулась. Их печатаем отдельно, чтобы не вернуть дважды.
+    """
+    async with db.execute(
+        """
+        SELECT uid, SUM(amount), COUNT(*) FROM (
+            SELECT creator_id AS uid, bet AS amount FROM games
+            WHERE abandoned = 1 AND opponent_id IS NOT NULL
+            UNION ALL
+            SELECT opponent_id, bet FROM games
+            WHERE abandoned = 1 AND opponent_id IS NOT NULL
+            UNION ALL
+            SELECT b.user_id, b.amount FROM raffle_bets b
+            JOIN raffle_rounds r ON r.id = b.round_id WHERE r.abandoned = 1
+        ) GROUP BY uid ORDER BY SUM(amount) DESC
+        """
+    ) as cur:
+        stranded = await cur.fetchall()
+    async with db.execute(
+        """
+        SELECT id, creator_id, bet FROM games
+        WHERE abandoned = 1 AND opponent_id IS NULL ORDER BY id
+        """
+    ) as cur:
+        unknown = await cur.fetchall()
+    if not stranded and not unknown:
+        return
+
+    print("[MIGRATION] Незавершённые игры и розыгрыши помечены abandoned = 1.")
+    if stranded:
+        total = sum(amount for _, amount, _ in stranded)
+        print(
+            f"[MIGRATION] Не возвращены (игры с соперником, розыгрыши): "
+            f"{total} монет у {len(stranded)} игроков"
+        )
+        for uid, amount, count in stranded[:top]:
+            print(f"[MIGRATION]   {uid}: {amount} монет (ставок: {count})")
+        if len(stranded) > top:
+            print(f"[MIGRATION]   ... и ещё {len(stranded) - top} игроков")
+    if unknown:
+        print(
+            f"[MIGRATION] Игры без соперника: {len(unknown)} шт., статус неизвестен "
+            f"(могли быть отменены с возвратом), сверить вручную перед возвратом:"
+        )
+        for gid, creator_id, bet in unknown[:top]:
+            print(f"[MIGRATION]   игра №{gid}: {creator_id}, ставка {bet} монет")
+        if len(unknown) > top:
+            print(f"[MIGRATION]   ... и ещё {len(unknown) - top} игр")
+
+
+async def _migration_games_client_seed(db: aiosqlite.Connection):
+    """Сид соперника для серверных бросков: задаётся при вступлении, раскрывается с итогом."""
+    await db.execute("ALTER TABLE games ADD COLUMN client_seed TEXT")
+
+
+# Миграции схемы по порядку: i-я переводит БД с версии i на i+1 (PRAGMA user_version).
+_MIGRATIONS = [
+    _migration_games_epoch,
+    _migration_user_stats,
+    _migration_user_buckets,
+    _migration_users_username,
+    _migration_ton_cursors,
+    _migration_games_fair_rolls,
+    _migration_raffle_rooms,
+    _migration_open_state,
+    _migration_games_client_seed,
+]
+
+
+async def _migrate(db: aiosqlite.Connection):
+    """Применить недостающие миграции и поднять user_version одной транзакцией.
+
+    sqlite3 сам открывает транзакцию только перед INSERT/UPDATE/DELETE, а ALTER TABLE
+    без неё фиксируется сразу: упавшая посередине миграция оставила бы новые колонки
+    при старом user_version, и каждый следующий старт падал бы на «duplicate column».
+    """
+    async with db.execute("PRAGMA user_version") as cur:
+        (version,) = await cur.fetchone()
+    if version >= len(_MIGRATIONS):
+        return
+    await db.execute("BEGIN")
+    try:
+        for step in _MIGRATIONS[version:]:
+            await step(db)
+        await db.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+    except BaseException:
+        await db.rollback()
+        raise
+    await db.commit()
+
+
+def queue_user_update(user_id: int, username: Any = _UNSET, balance: Any = _UNSET):
+    """Поставить изменение пользователя в очередь на запись (без ожидания БД)."""
+    fields = _pending_users.setdefault(user_id, {})
+    if username is not _UNSET:
+        fields["username"] = username
+    if balance is not _UNSET:
+        fields["balance"] = balance
+    if len(_pending_users) >= USER_FLUSH_BATCH_SIZE:
+        _flush_wakeup.set()
+
+
+async def flush_users():
+    """Записать все накопленные изменения пользователей одной транзакцией.
+
+    Пользователей, зарезервированных _write_with_users, не трогает: их изменения
+    запишет транзакция с игрой или ставкой.
+    """
+    if not _pending_users:
+        return
+    batch: dict[int, dict[str, Any]] = {}
+    try:
+        async with _write() as db:
+            # батч забираем уже под замком записи: иначе он мог бы записаться после
+            # транзакции, которая сама обновила баланс (add_ton_deposits), и затереть её
+            batch = {
+                uid: fields for uid, fields in _pending_users.items()
+                if uid not in _reserved_users
+            }
+            for uid in batch:
+                del _pending_users[uid]
+            _flushing_users.update(batch)
+            await _write_user_batch(db, batch)
+    except BaseException:
+        _requeue_user_batch(batch)
+        raise
+    finally:
+        _flushing_users.difference_update(batch)
+
+
+async def _write_user_batch(db: aiosqlite.Connection, batch: dict[int, dict[str, Any]]):
+    # группируем по набору изменённых колонок, чтобы писать только их
+    groups: dict[tuple[str, ...], list[tuple]] = {}
+    reg_date = datetime.now(UTC).isoformat()
+    for uid, fields in batch.items():
+        cols = tuple(c for c in _USER_COLUMNS if c in fields)
+        if cols:
+            groups.setdefault(cols, []).append(
+                (uid, *(fields[c] for c in cols), reg_date)
+            )
+
+    for cols, rows in groups.items():
+        await db.executemany(
+            f"""
+            INSERT INTO users (id, {", ".join(cols)}, reg_date)
+            VALUES (?, {", ".join("?" for _ in cols)}, ?)
             ON CONFLICT(id) DO UPDATE SET
-                username = excluded.username,
-                balance = excluded.balance
+                {", ".join(f"{c} = excluded.{c}" for c in cols)}
             """,
-            (user_id, username, balance, reg_date),
+            rows,
         )
-        await db.commit()
 
 
-async def upsert_game(game: Dict[str, Any]):
-    """Создать/обновить игру в БД по её id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+def _requeue_user_batch(batch: dict[int, dict[str, Any]]):
+    # возвращаем неудачный (или отменённый) батч в очередь, не затирая более свежие значения
+    for uid, fields in batch.items():
+        _pending_users[uid] = {**fields, **_pending_users.get(uid, {})}
+
+
+@asynccontextmanager
+async def _write_with_users(user_ids: Iterable[int]) -> AsyncIterator[aiosqlite.Connection]:
+    """_write(), который в той же транзакции сбрасывает отложенные изменения user_ids.
+
+    Ставки и выигрыши меняют баланс в кэше сразу, а в БД он попадает с задержкой;
+    строки игр и розыгрышей пишутся сразу. Без общей транзакции падение между ними
+    оставило бы в БД игру без списанной ставки (и восстановление вернуло бы её дважды).
+    Пока транзакция ждёт замка, user_ids зарезервированы: flush_users, занявший замок
+    раньше, не заберёт их изменения в свою транзакцию.
+    """
+    user_ids = set(user_ids)
+    for uid in user_ids:
+        _reserved_users[uid] = _reserved_users.get(uid, 0) + 1
+    batch: dict[int, dict[str, Any]] = {}
+    try:
+        async with _write() as db:
+            # под замком записи: в _pending_users уже последние значения из кэша
+            batch = {uid: _pending_users.pop(uid) for uid in user_ids if uid in _pending_users}
+            _flushing_users.update(batch)
+            await _write_user_batch(db, batch)
+            yield db
+    except BaseException:
+        _requeue_user_batch(batch)
+        raise
+    finally:
+        _flushing_users.difference_update(batch)
+        for uid in user_ids:
+            _reserved_users[uid] -= 1
+            if not _reserved_users[uid]:
+                del _reserved_users[uid]
+
+
+def is_user_dirty(user_id: int) -> bool:
+    """Есть ли у пользователя изменения, ещё не записанные в БД."""
+    return user_id in _pending_users or user_id in _flushing_users
+
+
+def pending_user_updates() -> int:
+    """Сколько пользователей ждут записи в БД."""
+    return len(_pending_users) + len(_flushing_users)
+
+
+async def _user_flush_worker():
+    while not _flusher_stopping:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=USER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        try:
+            await flush_users()
+        except Exception as e:
+            print("Ошибка при сохранении пользователей:", e)
+
+
+async def load_users(user_ids: List[int]) -> Dict[int, tuple[str | None, int]]:
+    """Загрузить пользователей по id: user_id -> (username, balance). Неизвестных нет в ответе."""
+    result: Dict[int, tuple[str | None, int]] = {}
+    async with _read() as db:
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            async with db.execute(
+                f"""
+                SELECT id, username, balance FROM users
+                WHERE id IN ({", ".join("?" for _ in chunk)})
+                """,
+                chunk,
+            ) as cur:
+                for uid, uname, bal in await cur.fetchall():
+                    result[int(uid)] = (uname, int(bal))
+    return result
+
+
+async def find_user_by_username(username: str) -> int | None:
+    """Найти id пользователя по username (без учёта регистра)."""
+    async with _read() as db:
+        async with db.execute(
+            "SELECT id FROM users WHERE username = ? COLLATE NOCASE LIMIT 1",
+            (username,),
+        ) as cur:
+            row = await cur.fetchone()
+            return int(row[0]) if row else None
+
+
+async def _upsert_game(db: aiosqlite.Connection, game: Dict[str, Any]):
+    await db.execute(
+        """
+        INSERT INTO games (
+            id, creator_id, opponent_id, bet,
+            creator_roll, opponent_roll, winner,
+            finished, created_at, finished_at,
+            created_ts, finished_ts,
+            roll_engine, seed_hash, server_seed, client_seed
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            creator_id = excluded.creator_id,
+            opponent_id = excluded.opponent_id,
+            bet = excluded.bet,
+            creator_roll = excluded.creator_roll,
+            opponent_roll = excluded.opponent_roll,
+            winner = excluded.winner,
+            finished = excluded.finished,
+            created_at = excluded.created_at,
+            finished_at = excluded.finished_at,
+            created_ts = excluded.created_ts,
+            finished_ts = excluded.finished_ts,
+            roll_engine = excluded.roll_engine,
+            seed_hash = excluded.seed_hash,
+            server_seed = excluded.server_seed,
+            client_seed = excluded.client_seed
+        """,
+        (
+            game.get("id"),
+            game.get("creator_id"),
+            game.get("opponent_id"),
+            game.get("bet"),
+            game.get("creator_roll"),
+            game.get("opponent_roll"),
+            game.get("winner"),
+            1 if game.get("finished") else 0,
+            game.get("created_at").isoformat() if game.get("created_at") else None,
+            game.get("finished_at").isoformat() if game.get("finished_at") else None,
+            int(game["created_at"].timestamp()) if game.get("created_at") else None,
+            int(game["finished_at"].timestamp()) if game.get("finished_at") else None,
+            game.get("roll_engine"),
+            game.get("seed_hash"),
+            game.get("server_seed"),
+            game.get("client_seed"),
+        ),
+    )
+
+
+async def upsert_game(game: Dict[str, Any], user_ids: Iterable[int] = ()):
+    """Создать/обновить игру в БД по её id.
+
+    user_ids: чьи балансы изменились вместе с игрой (ставка) — пишутся той же транзакцией.
+    """
+    async with _write_with_users(user_ids) as db:
+        await _upsert_game(db, game)
+
+
+async def delete_game(game_id: int, user_ids: Iterable[int] = ()):
+    """Удалить несыгранную игру (ставку отменили или истёк таймер) вместе с возвратом ставок."""
+    async with _write_with_users(user_ids) as db:
+        await db.execute("DELETE FROM games WHERE id = ? AND finished = 0", (game_id,))
+
+
+async def settle_game(
+    game: Dict[str, Any], profits: Dict[int, int], user_ids: Iterable[int] = ()
+):
+    """Сохранить результат игры, выплаты и обновить user_stats в одной транзакции.
+
+    profits: user_id -> профит игрока в этой игре (см. calculate_profit в bot.py).
+    user_ids: чьи балансы изменились расчётом (игроки и комиссия).
+    """
+    async with _write_with_users(user_ids) as db:
+        await _upsert_game(db, game)
+        await db.executemany(
             """
-            INSERT INTO games (
-                id, creator_id, opponent_id, bet,
-                creator_roll, opponent_roll, winner,
-                finished, created_at, finished_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                creator_id = excluded.creator_id,
-                opponent_id = excluded.opponent_id,
-                bet = excluded.bet,
-                creator_roll = excluded.creator_roll,
-                opponent_roll = excluded.opponent_roll,
-                winner = excluded.winner,
-                finished = excluded.finished,
-                created_at = excluded.created_at,
-                finished_at = excluded.finished_at
+            INSERT INTO user_stats (user_id, profit, games, wins)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                profit = profit + excluded.profit,
+                games = games + 1,
+                wins = wins + excluded.wins
             """,
-            (
-                game.get("id"),
-                game.get("creator_id"),
-                game.get("opponent_id"),
-                game.get("bet"),
-                game.get("creator_roll"),
-                game.get("opponent_roll"),
-                game.get("winner"),
-                1 if game.get("finished") else 0,
-                game.get("created_at").isoformat() if game.get("created_at") else None,
-                game.get("finished_at").isoformat() if game.get("finished_at") else None,
-            ),
+            [(uid, p, 1 if p > 0 else 0) for uid, p in profits.items()],
+        )
+
+        ts = game.get("finished_at")
+        if not ts:
+            return
+        ts = int(ts.timestamp())
+        hour_ts = ts - ts % HOUR_SECONDS
+        day_ts = ts - ts % DAY_SECONDS
+        for table, col, bucket in (
+            ("user_stats_hourly", "hour_ts", hour_ts),
+            ("user_stats_daily", "day_ts", day_ts),
+        ):
+            await db.executemany(
+                f"""
+                INSERT INTO {table} (user_id, {col}, games, profit)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(user_id, {col}) DO UPDATE SET
+                    games = games + 1,
+                    profit = profit + excluded.profit
+                """,
+                [(uid, bucket, p) for uid, p in profits.items()],
+            )
+        await db.executemany(
+            "DELETE FROM user_stats_hourly WHERE user_id = ? AND hour_ts < ?",
+            [(uid, ts - HOURLY_BUCKETS_KEEP_SECONDS) for uid in profits],
         )
-        await db.commit()
 
 
-async def get_user_games(uid: int) -> List[Dict[str, Any]]:
-    """Получить все завершённые игры пользователя (для статистики/истории)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def get_user_games(uid: int, limit: int) -> List[Dict[str, Any]]:
+    """Последние завершённые игры пользователя (для истории)."""
+    async with _read() as db:
         async with db.execute(
             """
-            SELECT *
-            FROM games
-            WHERE finished = 1
-              AND (creator_id = ? OR opponent_id = ?)
-            ORDER BY datetime(finished_at) DESC
+            SELECT * FROM games
+            WHERE finished = 1 AND creator_id = ?
+            UNION ALL
+            SELECT * FROM games
+            WHERE finished = 1 AND opponent_id = ? AND creator_id != ?
+            ORDER BY finished_ts DESC
+            LIMIT ?
             """,
-            (uid, uid),
+            (uid, uid, uid, limit),
         ) as cur:
             rows = await cur.fetchall()
             return [dict(row) for row in rows]
 
 
-async def get_all_finished_games() -> List[Dict[str, Any]]:
-    """Все завершённые игры (для рейтинга)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def get_user_period_stats(uid: int, since_ts: int) -> Dict[str, int]:
+    """Число игр и профит пользователя с момента since_ts (с точностью до часа).
+
+    Полные сутки берутся из суточных корзин, неполные первые сутки — из часовых.
+    """
+    since_hour = since_ts - since_ts % HOUR_SECONDS
+    first_full_day = -(-since_hour // DAY_SECONDS) * DAY_SECONDS
+    async with _read() as db:
         async with db.execute(
             """
-            SELECT *
-            FROM games
-            WHERE finished = 1
+            SELECT COALESCE(SUM(games), 0), COALESCE(SUM(profit), 0)
+            FROM (
+                SELECT games, profit FROM user_stats_daily
+                WHERE user_id = ? AND day_ts >= ?
+                UNION ALL
+                SELECT games, profit FROM user_stats_hourly
+                WHERE user_id = ? AND hour_ts >= ? AND hour_ts < ?
+            )
+            """,
+            (uid, first_full_day, uid, since_hour, first_full_day),
+        ) as cur:
+            games_count, profit = await cur.fetchone()
+            return {"games": games_count, "profit": profit}
+
+
+async def get_top_profit(limit: int = 10) -> List[Dict[str, Any]]:
+    """ТОП игроков по профиту (для рейтинга)."""
+    async with _read() as db:
+        async with db.execute(
             """
+            SELECT user_id, profit, games, wins
+            FROM user_stats
+            ORDER BY profit DESC
+            LIMIT ?
+            """,
+            (limit,),
         ) as cur:
             rows = await cur.fetchall()
             return [dict(row) for row in rows]
 
 
-async def upsert_raffle_round(raffle_round: Dict[str, Any]):
-    """Создать/обновить запись розыгрыша (банкир)."""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def rebuild_user_stats():
+    """Пересчитать user_stats и корзины статистики с нуля по таблице games."""
+    async with _write() as db:
+        await _rebuild_user_stats(db)
+        await _rebuild_user_buckets(db)
+
+
+async def upsert_raffle_round(raffle_round: Dict[str, Any], user_ids: Iterable[int] = ()):
+    """Создать/обновить запись розыгрыша (банкир); user_ids — как в upsert_game."""
+    async with _write_with_users(user_ids) as db:
         await db.execute(
             """
-            INSERT INTO raffle_rounds (id, created_at, finished_at, winner_id, total_bank)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO raffle_rounds (id, created_at, finished_at, winner_id, total_bank, room)
+            VALUES (?, ?, ?, ?, ?, ?)
             ON CONFLICT(id) DO UPDATE SET
                 created_at = excluded.created_at,
                 finished_at = excluded.finished_at,
                 winner_id = excluded.winner_id,
-                total_bank = excluded.total_bank
+                total_bank = excluded.total_bank,
+                room = excluded.room
             """,
             (
                 raffle_round.get("id"),
@@ -198,14 +842,14 @@ async def upsert_raffle_round(raffle_round: Dict[str, Any]):
                 else None,
                 raffle_round.get("winner_id"),
                 raffle_round.get("total_bank"),
+                raffle_round.get("room"),
             ),
         )
-        await db.commit()
 
 
 async def add_raffle_bet(round_id: int, user_id: int, amount: int):
-    """Добавить ставку в розыгрыше."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Добавить ставку в розыгрыше вместе со списанием её с баланса."""
+    async with _write_with_users((user_id,)) as db:
         await db.execute(
             """
             INSERT INTO raffle_bets (round_id, user_id, amount)
@@ -213,34 +857,68 @@ async def add_raffle_bet(round_id: int, user_id: int, amount: int):
             """,
             (round_id, user_id, amount),
         )
-        await db.commit()
 
 
-async def add_ton_deposit(
-    tx_hash: str,
-    user_id: int,
-    ton_amount: float,
-    coins_amount: int,
-    comment: str,
-):
-    """Сохранить пополнение TON в БД."""
+async def add_ton_deposits(
+    wallet: str,
+    lt: int,
+    deposits: List[tuple[str, int, float, int, str]],
+    balances: Dict[int, int],
+) -> List[tuple[str, int, float, int, str]]:
+    """Записать пачку пополнений TON, зачислить их и сдвинуть курсор одной транзакцией.
+
+    deposits: (tx_hash, user_id, ton_amount, coins_amount, comment).
+    balances: текущие балансы получателей (из кэша бота); новым пополнениям в users
+    пишется баланс + зачисление, так что падение после commit не теряет монеты.
+    Возвращает только новые пополнения — уже записанные раньше хэши пропускаются.
+    """
     ts = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    inserted = []
+    credited: Dict[int, int] = {}
+    async with _write() as db:
+        for dep in deposits:
+            cur = await db.execute(
+                """
+                INSERT OR IGNORE INTO ton_deposits
+                (tx_hash, user_id, ton_amount, coins_amount, comment, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (*dep, ts),
+            )
+            if cur.rowcount == 1:
+                inserted.append(dep)
+                credited[dep[1]] = credited.get(dep[1], 0) + dep[3]
+        await db.executemany(
+            """
+            INSERT INTO users (id, balance, reg_date) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET balance = excluded.balance
+            """,
+            [(uid, balances[uid] + coins, ts) for uid, coins in credited.items()],
+        )
         await db.execute(
             """
-            INSERT OR IGNORE INTO ton_deposits
-            (tx_hash, user_id, ton_amount, coins_amount, comment, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO ton_cursors (wallet, lt) VALUES (?, ?)
+            ON CONFLICT(wallet) DO UPDATE SET lt = MAX(lt, excluded.lt)
             """,
-            (tx_hash, user_id, ton_amount, coins_amount, comment, ts),
+            (wallet, lt),
         )
-        await db.commit()
+    return inserted
+
+
+async def get_ton_cursor(wallet: str) -> int:
+    """Logical time последней обработанной транзакции кошелька (0 — ещё не обрабатывали)."""
+    async with _read() as db:
+        async with db.execute(
+            "SELECT lt FROM ton_cursors WHERE wallet = ?", (wallet,)
+        ) as cur:
+            row = await cur.fetchone()
+            return int(row[0]) if row else 0
 
 
 async def add_transfer(from_user: int, to_user: int, amount: int):
-    """Сохранить перевод монет между пользователями."""
+    """Сохранить перевод монет между пользователями вместе с балансами обоих."""
     ts = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write_with_users((from_user, to_user)) as db:
         await db.execute(
             """
             INSERT INTO transfers (from_user, to_user, amount, timestamp)
@@ -248,4 +926,3 @@ async def add_transfer(from_user: int, to_user: int, amount: int):
             """,
             (from_user, to_user, amount, ts),
         )
-        await db.commit()
@@ -0,0 +1,40 @@
+import hashlib
+import hmac
+import secrets
+
+# Честные броски на стороне сервера (commit-reveal):
+# при создании игры публикуем sha256(seed), после игры раскрываем seed.
+# client_seed появляется только при вступлении соперника (его не знает никто, у кого есть
+# seed на момент создания игры), поэтому исход нельзя просчитать заранее.
+# Броски — HMAC-SHA256(seed, "game_id:creator_id:opponent_id:client_seed:counter"),
+# counter = 0, 1, ...: байты 0..251 -> 1..6, остальные байты пропускаются,
+# чтобы все грани были равновероятны.
+
+
+def new_server_seed() -> str:
+    return secrets.token_hex(32)
+
+
+def seed_hash(seed: str) -> str:
+    return hashlib.sha256(seed.encode()).hexdigest()
+
+
+def roll_message(game_id: int, creator_id: int, opponent_id: int, client_seed: str = "") -> str:
+    return f"{game_id}:{creator_id}:{opponent_id}:{client_seed}"
+
+
+def roll_dice(seed: str, message: str, count: int = 2) -> list[int]:
+    """Детерминированные броски кубика из seed и сообщения — их может повторить любой игрок."""
+    rolls: list[int] = []
+    counter = 0
+    while len(rolls) < count:
+        digest = hmac.new(
+            seed.encode(), f"{message}:{counter}".encode(), hashlib.sha256
+        ).digest()
+        for byte in digest:
+            if byte < 252:
+                rolls.append(byte % 6 + 1)
+                if len(rolls) == count:
+                    break
+        counter += 1
+    return rolls
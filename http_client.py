@@ -0,0 +1,139 @@
+import asyncio
+import json
+import random
+import time
+from typing import Any, AsyncIterator, Dict
+
+import aiohttp
+
+HTTP_TIMEOUT = 10               # секунд на весь запрос
+HTTP_CONNECT_TIMEOUT = 5        # секунд на установку соединения
+HTTP_LIMIT_PER_HOST = 10        # одновременных соединений к одному хосту
+HTTP_KEEPALIVE_TIMEOUT = 60     # сколько держать простаивающее соединение
+HTTP_RETRIES = 3                # попыток на запрос (включая первую)
+HTTP_BACKOFF_BASE = 0.5         # секунд, удваивается с каждой попыткой (+ случайный джиттер)
+SSE_READ_TIMEOUT = 60           # поток считается оборванным, если столько секунд тишины
+
+# Один пул соединений (aiohttp.ClientSession) на каждый внешний сервис.
+# Сессии создаются при первом запросе и закрываются в close_http (из main).
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+# upstream -> счётчики: запросы, ошибки, повторы, суммарная и максимальная задержка
+http_stats: Dict[str, Dict[str, float]] = {}
+
+
+class HTTPStatusRetry(Exception):
+    """Ответ с кодом, на который стоит повторить запрос (429, 5xx)."""
+
+
+def _get_session(upstream: str) -> aiohttp.ClientSession:
+    session = _sessions.get(upstream)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT
+            ),
+        )
+        _sessions[upstream] = session
+    return session
+
+
+def _stats(upstream: str) -> Dict[str, float]:
+    return http_stats.setdefault(
+        upstream,
+        {"requests": 0, "failures": 0, "retries": 0, "latency_total": 0.0, "latency_max": 0.0},
+    )
+
+
+async def get_json(upstream: str, url: str, params: Dict[str, Any] | None = None) -> Any:
+    """GET-запрос через пул соединений upstream с повторами и джиттером.
+
+    Повторяем на сетевые ошибки, таймауты, 429 и 5xx; после HTTP_RETRIES попыток
+    пробрасываем последнюю ошибку. Остальные 4xx пробрасываем сразу.
+    """
+    stats = _stats(upstream)
+    session = _get_session(upstream)
+
+    for attempt in range(HTTP_RETRIES):
+        started = time.monotonic()
+        stats["requests"] += 1
+        try:
+            async with session.get(url, params=params) as resp:
+                if resp.status == 429 or resp.status >= 500:
+                    raise HTTPStatusRetry(f"{resp.status} {resp.reason}")
+                resp.raise_for_status()
+                data = await resp.json()
+        except aiohttp.ClientResponseError:
+            # прочие 4xx повтором не исправить
+            stats["failures"] += 1
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, HTTPStatusRetry):
+            stats["failures"] += 1
+            if attempt + 1 >= HTTP_RETRIES:
+                raise
+            stats["retries"] += 1
+            delay = HTTP_BACKOFF_BASE * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            continue
+        finally:
+            latency = time.monotonic() - started
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+        return data
+
+
+async def stream_sse(
+    upstream: str, url: str, params: Dict[str, Any] | None = None
+) -> AsyncIterator[Any]:
+    """Подписка на server-sent events: отдаёт JSON из data каждого события.
+
+    Служебные события heartbeat пропускаются. Итерация заканчивается, когда сервер
+    закрыл поток; обрыв соединения или долгая тишина — исключение.
+    """
+    stats = _stats(upstream)
+    timeout = aiohttp.ClientTimeout(
+        total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=SSE_READ_TIMEOUT
+    )
+    try:
+        async with _get_session(upstream).get(url, params=params, timeout=timeout) as resp:
+            resp.raise_for_status()
+            event, data = "message", []
+            async for raw in resp.content:
+                line = raw.decode("utf-8").rstrip("\r\n")
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif not line:
+                    if data and event != "heartbeat":
+                        try:
+                            yield json.loads("\n".join(data))
+                        except ValueError:
+                            pass
+                    event, data = "message", []
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        stats["failures"] += 1
+        raise
+
+
+def format_http_stats() -> str:
+    lines = []
+    for upstream, s in sorted(http_stats.items()):
+        avg = s["latency_total"] / s["requests"] if s["requests"] else 0.0
+        lines.append(
+            f"{upstream}: запросов {int(s['requests'])}, ошибок {int(s['failures'])}, "
+            f"повторов {int(s['retries'])}, задержка ср. {avg * 1000:.0f} мс / "
+            f"макс. {s['latency_max'] * 1000:.0f} мс"
+        )
+    return "\n".join(lines) or "HTTP-запросов ещё не было."
+
+
+async def close_http():
+    """Закрыть все пулы соединений (при остановке бота)."""
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Dict
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+# Все фоновые сообщения (результаты игр, розыгрышей, пополнения, заявки админам)
+# идут через эту очередь, чтобы не упираться в лимиты Telegram и не терять сообщения.
+OUTBOX_GLOBAL_RATE = 30          # сообщений в секунду на весь бот
+OUTBOX_PER_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+OUTBOX_SENDERS = 8               # одновременных запросов к Bot API
+OUTBOX_MAX_ATTEMPTS = 5          # попыток на сетевые/серверные ошибки
+OUTBOX_BACKOFF_BASE = 1.0        # секунд, удваивается с каждой попыткой
+OUTBOX_PRUNE_INTERVAL = 60.0     # секунд между чистками устаревших записей по чатам
+
+# Приоритеты: меньше — раньше
+PRIORITY_GAME = 0     # результаты игр и розыгрышей, зачисления
+PRIORITY_NORMAL = 1   # прочие уведомления пользователям
+PRIORITY_ADMIN = 2    # уведомления админам
+
+_PRIORITY_NAMES = {PRIORITY_GAME: "игры", PRIORITY_NORMAL: "обычные", PRIORITY_ADMIN: "админ"}
+
+_bot: Bot | None = None
+_queue: asyncio.PriorityQueue | None = None
+_senders: list[asyncio.Task] = []
+_seq = itertools.count()
+_chat_next_at: Dict[int, float] = {}  # chat_id -> когда можно следующее сообщение
+_chat_flood_until: Dict[int, float] = {}  # chat_id -> до какого момента действует RetryAfter
+_chat_epoch: Dict[int, int] = {}  # chat_id -> номер RetryAfter; слоты из прошлых эпох заняты заново
+_chat_pending: Dict[int, int] = {}  # chat_id -> сколько его сообщений ещё не отправлено
+_pruned_at = 0.0
+_tokens = float(OUTBOX_GLOBAL_RATE)
+_tokens_at = 0.0
+
+outbox_stats: Dict[str, int] = {
+    "sent": 0, "failed": 0, "blocked": 0, "retry_after": 0, "retries": 0,
+}
+_pending_by_priority: Dict[int, int] = {p: 0 for p in _PRIORITY_NAMES}
+
+
+def start_outbox(bot: Bot):
+    """Запустить отправителей (из main)."""
+    global _bot, _queue
+    _bot = bot
+    if _queue is None:
+        _queue = asyncio.PriorityQueue()
+    while len(_senders) < OUTBOX_SENDERS:
+        _senders.append(asyncio.create_task(_sender()))
+
+
+def queue_message(
+    chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs: Any
+) -> asyncio.Future:
+    """Поставить сообщение в очередь, не дожидаясь отправки.
+
+    Возвращает future с итогом: "sent", "blocked" (пользователь заблокировал бота)
+    или "failed". Ждать его не обязательно.
+    """
+    global _queue
+    if _queue is None:
+        _queue = asyncio.PriorityQueue()
+    result = asyncio.get_running_loop().create_future()
+    _pending_by_priority[priority] = _pending_by_priority.get(priority, 0) + 1
+    _chat_pending[chat_id] = _chat_pending.get(chat_id, 0) + 1
+    _queue.put_nowait((priority, next(_seq), 0.0, 0, 0, chat_id, text, kwargs, result))
+    return result
+
+
+async def _take_global_token():
+    """Глобальный token bucket на OUTBOX_GLOBAL_RATE сообщений в секунду."""
+    global _tokens, _tokens_at
+    while True:
+        now = time.monotonic()
+        _tokens = min(
+            float(OUTBOX_GLOBAL_RATE), _tokens + (now - _tokens_at) * OUTBOX_GLOBAL_RATE
+        )
+        _tokens_at = now
+        if _tokens >= 1:
+            _tokens -= 1
+            return
+        await asyncio.sleep((1 - _tokens) / OUTBOX_GLOBAL_RATE)
+
+
+def _prune_chats(now: float):
+    """Забыть прошедшие слоты и паузы: без записи чат ведёт себя так же."""
+    global _pruned_at
+    _pruned_at = now
+    for times in (_chat_next_at, _chat_flood_until):
+        for chat_id in [c for c, t in times.items() if t <= now]:
+            del times[chat_id]
+
+
+def _requeue_later(delay: float, item: tuple):
+    asyncio.get_running_loop().call_later(delay, _queue.put_nowait, item)
+
+
+def _finish(priority: int, chat_id: int, result: asyncio.Future, status: str):
+    _pending_by_priority[priority] -= 1
+    _chat_pending[chat_id] -= 1
+    if not _chat_pending[chat_id]:
+        # сообщений чата с эпохой в очереди больше нет — номер эпохи не нужен
+        del _chat_pending[chat_id]
+        _chat_epoch.pop(chat_id, None)
+    outbox_stats[status] += 1
+    if not result.done():
+        result.set_result(status)
+
+
+async def _sender():
+    while True:
+        item = await _queue.get()
+        priority, seq, not_before, epoch, attempt, chat_id, text, kwargs, result = item
+        try:
+            now = time.monotonic()
+            if now - _pruned_at >= OUTBOX_PRUNE_INTERVAL:
+                _prune_chats(now)
+            if not_before > now:
+                # ещё рано (ждём свой слот в чате или паузу перед повтором)
+                _requeue_later(not_before - now, item)
+                continue
+
+            flood_until = _chat_flood_until.get(chat_id, 0.0)
+            if flood_until > now:
+                # чат на паузе по RetryAfter
+                _requeue_later(flood_until - now, item)
+                continue
+
+            chat_epoch = _chat_epoch.get(chat_id, 0)
+            if not not_before or epoch != chat_epoch:
+                # лимит на чат: занимаем слот (заново, если после него был RetryAfter),
+                # а если слот в будущем — откладываем сообщение до него
+                slot = max(now, _chat_next_at.get(chat_id, 0.0))
+                _chat_next_at[chat_id] = slot + OUTBOX_PER_CHAT_INTERVAL
+                if slot > now:
+                    _requeue_later(
+                        slot - now,
+                        (priority, seq, slot, chat_epoch, attempt, chat_id, text, kwargs, result),
+                    )
+                    continue
+
+            await _take_global_token()
+            try:
+                await _bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                # все занятые слоты чата недействительны: после паузы их займут заново
+                outbox_stats["retry_after"] += 1
+                _chat_flood_until[chat_id] = time.monotonic() + e.retry_after
+                _chat_next_at[chat_id] = _chat_flood_until[chat_id]
+                _chat_epoch[chat_id] = chat_epoch + 1
+                _requeue_later(
+                    e.retry_after,
+                    (priority, seq, 0.0, 0, attempt, chat_id, text, kwargs, result),
+                )
+            except TelegramForbiddenError:
+                _finish(priority, chat_id, result, "blocked")
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    _finish(priority, chat_id, result, "failed")
+                else:
+                    outbox_stats["retries"] += 1
+                    delay = OUTBOX_BACKOFF_BASE * 2 ** attempt
+                    _requeue_later(
+                        delay,
+                        (priority, seq, 0.0, 0, attempt + 1, chat_id, text, kwargs, result),
+                    )
+            except Exception:
+                _finish(priority, chat_id, result, "failed")
+            else:
+                _finish(priority, chat_id, result, "sent")
+        finally:
+            _queue.task_done()
+
+
+def outbox_depth() -> int:
+    """Сколько сообщений ещё не отправлено (в очереди и отложенных)."""
+    return sum(_pending_by_priority.values())
+
+
+def format_outbox_stats() -> str:
+    by_priority = ", ".join(
+        f"{_PRIORITY_NAMES.get(p, p)}: {n}" for p, n in sorted(_pending_by_priority.items())
+    )
+    return (
+        f"в очереди: {outbox_depth()} ({by_priority})\n"
+        f"отправлено: {outbox_stats['sent']}, заблокировано: {outbox_stats['blocked']}, "
+        f"ошибок: {outbox_stats['failed']}\n"
+        f"RetryAfter: {outbox_stats['retry_after']}, повторов: {outbox_stats['retries']}"
+    )
+
+
+async def close_outbox(timeout: float = 10):
+    """Дождаться отправки очереди (не дольше timeout) и остановить отправителей."""
+    deadline = time.monotonic() + timeout
+    while outbox_depth() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    for task in _senders:
+        task.cancel()
+    _senders.clear()
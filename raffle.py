@@ -0,0 +1,42 @@
+import bisect
+import secrets
+from datetime import datetime, UTC
+
+# Розыгрыш (банкир): раунд — dict, как и раньше сохраняется через upsert_raffle_round.
+# Каждая ставка — отдельная запись в entries с накопленной суммой в cumulative,
+# поэтому ставка добавляется за O(1), а победитель выбирается бинарным поиском.
+
+
+def new_raffle_round(round_id: int, room: int = 0) -> dict:
+    return {
+        "id": round_id,
+        "room": room,        # индекс комнаты (RAFFLE_ROOMS в bot.py)
+        "bets": {},          # user_id -> сумма всех ставок игрока
+        "entries": [],       # user_id каждой ставки по порядку
+        "cumulative": [],    # накопленная сумма ставок после каждой записи entries
+        "total_bank": 0,     # банк (сумма всех ставок), ведётся по ходу
+        "created_at": datetime.now(UTC),
+        "finished_at": None,
+        "winner_id": None,
+    }
+
+
+def raffle_add_bet(raffle_round: dict, uid: int, amount: int):
+    bets = raffle_round["bets"]
+    bets[uid] = bets.get(uid, 0) + amount
+    raffle_round["total_bank"] += amount
+    raffle_round["entries"].append(uid)
+    raffle_round["cumulative"].append(raffle_round["total_bank"])
+
+
+def raffle_chance(raffle_round: dict, uid: int) -> float:
+    """Шанс игрока на победу в процентах."""
+    total = raffle_round["total_bank"]
+    return raffle_round["bets"].get(uid, 0) / total * 100 if total > 0 else 0.0
+
+
+def raffle_draw(raffle_round: dict) -> int:
+    """Выбрать победителя с вероятностью, пропорциональной ставкам (целые числа, CSPRNG)."""
+    ticket = secrets.randbelow(raffle_round["total_bank"])
+    i = bisect.bisect_right(raffle_round["cumulative"], ticket)
+    return raffle_round["entries"][i]
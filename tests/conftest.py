@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Отдельная SQLite-база на тест.
+
+    Примитивы asyncio в db создаются при импорте и привязываются к первому циклу
+    событий, а каждый тест идёт в своём asyncio.run — поэтому тесту свои.
+    """
+    import asyncio
+
+    import db
+
+    path = str(tmp_path / "database.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(db, "_write_lock", asyncio.Lock())
+    monkeypatch.setattr(db, "_flush_wakeup", asyncio.Event())
+    monkeypatch.setattr(db, "_pending_users", {})
+    monkeypatch.setattr(db, "_flushing_users", set())
+    monkeypatch.setattr(db, "_reserved_users", {})
+    return path
@@ -0,0 +1,316 @@
+import asyncio
+import random
+from collections import OrderedDict
+from datetime import datetime, UTC
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import db
+
+USERS = list(range(5000, 5050))
+
+
+@pytest.fixture(autouse=True)
+def fresh_balances(db_path, monkeypatch):
+    """Кэш балансов и замки — глобальные и привязаны к циклу событий; каждому тесту свои."""
+    monkeypatch.setattr(bot, "user_balances", OrderedDict())
+    monkeypatch.setattr(bot, "games", {})
+    monkeypatch.setattr(bot, "open_game_ids", [[] for _ in bot.open_game_ids])
+    monkeypatch.setattr(bot, "_game_deadlines", {})
+    monkeypatch.setattr(bot, "_game_expiry_heap", [])
+    monkeypatch.setattr(bot, "_game_expiry_wakeup", asyncio.Event())
+    monkeypatch.setattr(
+        bot, "_balance_locks", [asyncio.Lock() for _ in range(bot.BALANCE_LOCK_STRIPES)]
+    )
+
+
+def _check_no_negative():
+    negative = {uid: bal for uid, bal in bot.user_balances.items() if bal < 0}
+    assert not negative
+
+
+def test_debit_if_sufficient():
+    bot.set_balance(1, 100)
+
+    assert not bot.debit_if_sufficient(1, 101)
+    assert not bot.debit_if_sufficient(1, 0)
+    assert not bot.debit_if_sufficient(1, -5)
+    assert bot.get_balance(1) == 100
+    assert bot.debit_if_sufficient(1, 100)
+    assert bot.get_balance(1) == 0
+    assert not bot.debit_if_sufficient(1, 1)
+
+
+def test_transfer_balance_is_all_or_nothing():
+    bot.set_balance(1, 50)
+    bot.set_balance(2, 0)
+
+    assert not bot.transfer_balance(1, 2, 51)
+    assert (bot.get_balance(1), bot.get_balance(2)) == (50, 0)
+    assert bot.transfer_balance(1, 2, 50)
+    assert (bot.get_balance(1), bot.get_balance(2)) == (0, 50)
+    assert bot.transfer_balance(2, 2, 50)  # самому себе — баланс не меняется
+    assert bot.get_balance(2) == 50
+
+
+def test_user_locks_serialize_and_do_not_deadlock():
+    stripes = bot.BALANCE_LOCK_STRIPES
+    inside: dict[int, int] = {}
+    overlaps = []
+
+    async def hold(*uids):
+        async with bot.user_locks(*uids):
+            for uid in uids:
+                inside[uid] = inside.get(uid, 0) + 1
+                if inside[uid] > 1:
+                    overlaps.append(uid)
+            await asyncio.sleep(0)
+            for uid in uids:
+                inside[uid] -= 1
+
+    async def scenario():
+        tasks = []
+        for _ in range(500):
+            # встречные пары, общий страйп (uid и uid + stripes) и одиночные
+            tasks += [hold(1, 2), hold(2, 1), hold(3, 3 + stripes), hold(3 + stripes, 1), hold(2)]
+        await asyncio.wait_for(asyncio.gather(*tasks), 10)
+
+    asyncio.run(scenario())
+
+    assert not overlaps
+
+
+def test_racing_transfers_never_overdraw():
+    rng = random.Random(25)
+    for uid in USERS:
+        bot.set_balance(uid, 100)
+    total = sum(bot.get_balance(uid) for uid in USERS)
+    done = {"ok": 0, "refused": 0}
+
+    async def transfer(from_uid, to_uid, amount):
+        # как перевод в process_text: проверка и списание под замком, запись в БД — с await
+        async with bot.user_locks(from_uid, to_uid):
+            await asyncio.sleep(0)
+            ok = bot.transfer_balance(from_uid, to_uid, amount)
+            await asyncio.sleep(0)
+        done["ok" if ok else "refused"] += 1
+        _check_no_negative()
+
+    async def debit(uid, amount):
+        async with bot.user_locks(uid):
+            await asyncio.sleep(0)
+            ok = bot.debit_if_sufficient(uid, amount)
+        done["ok" if ok else "refused"] += 1
+        _check_no_negative()
+        return amount if ok else 0
+
+    async def scenario():
+        tasks = []
+        for _ in range(4000):
+            a, b = rng.sample(USERS, 2)
+            tasks.append(transfer(a, b, rng.randint(1, 150)))
+        debits = [debit(rng.choice(USERS), rng.randint(1, 80)) for _ in range(1000)]
+        rng.shuffle(tasks)
+        results = await asyncio.gather(*debits, *tasks)
+        return sum(results[:len(debits)])
+
+    debited = asyncio.run(scenario())
+
+    _check_no_negative()
+    assert done["ok"] + done["refused"] == 5000
+    assert done["ok"] and done["refused"]  # были и успешные, и отказы по балансу
+    assert sum(bot.get_balance(uid) for uid in USERS) == total - debited
+
+
+class FakeCallback:
+    """Нажатие «Вступить»: только то, что трогает cb_join_confirm."""
+
+    def __init__(self, uid: int, gid: int, answers: list):
+        self.id = f"cb-{uid}-{gid}"
+        self.from_user = SimpleNamespace(id=uid)
+        self.data = f"join_confirm:{gid}"
+        self._answers = answers
+        self.message = SimpleNamespace(answer=self._message_answer)
+
+    async def answer(self, text=None, show_alert=False):
+        if text:
+            self._answers.append((self.from_user.id, text))
+
+    async def _message_answer(self, text, **kwargs):
+        await asyncio.sleep(0)
+
+
+def _open_game(gid: int, creator_id: int, bet: int) -> dict:
+    g = {
+        "id": gid,
+        "creator_id": creator_id,
+        "opponent_id": None,
+        "bet": bet,
+        "creator_roll": None,
+        "opponent_roll": None,
+        "winner": None,
+        "finished": False,
+        "created_at": datetime.now(UTC),
+        "finished_at": None,
+        "roll_engine": "server",
+        "server_seed": "seed",
+        "seed_hash": "hash",
+        "client_seed": None,
+    }
+    bot.games[gid] = g
+    bot.index_open_game(g)
+    bot.schedule_game_expiry(gid)
+    return g
+
+
+def test_racing_join_confirm(monkeypatch):
+    rng = random.Random(2025)
+    started: list[int] = []
+    answers: list[tuple[int, str]] = []
+
+    async def slow_upsert(game, user_ids=()):
+        await asyncio.sleep(rng.random() / 1000)
+
+    monkeypatch.setattr(bot, "upsert_game", slow_upsert)
+    monkeypatch.setattr(bot, "start_game", started.append)
+
+    creator, bet = 1, 100
+    game_ids = list(range(1, 201))
+    for gid in game_ids:
+        _open_game(gid, creator, bet)
+    # у каждого хватает на 0–3 игры; создатель тоже пытается вступить в свои
+    for uid in USERS:
+        bot.set_balance(uid, bet * rng.randint(0, 3) + rng.randint(0, bet - 1))
+    bot.set_balance(creator, 10_000)
+    before = {uid: bot.get_balance(uid) for uid in USERS}
+
+    async def scenario():
+        clicks = [
+            bot.cb_join_confirm(FakeCallback(uid, gid, answers))
+            for gid in game_ids
+            for uid in rng.sample(USERS, 15) + [creator]
+        ]
+        rng.shuffle(clicks)
+        await asyncio.gather(*clicks)
+
+    asyncio.run(scenario())
+
+    _check_no_negative()
+    # денег у игроков меньше, чем на все игры: часть остаётся ждать соперника
+    taken = [gid for gid in game_ids if bot.games[gid]["opponent_id"] is not None]
+    assert 0 < len(taken) < len(game_ids)
+    assert sorted(started) == taken  # каждая занятая игра запущена ровно один раз
+    joined: dict[int, int] = {}
+    for gid in taken:
+        g = bot.games[gid]
+        assert g["opponent_id"] in USERS
+        assert g["client_seed"] == f"cb-{g['opponent_id']}-{gid}"
+        joined[g["opponent_id"]] = joined.get(g["opponent_id"], 0) + 1
+    # списано ровно по ставке за каждую игру, где игрок стал соперником
+    for uid in USERS:
+        assert bot.get_balance(uid) == before[uid] - bet * joined.get(uid, 0)
+    assert bot.get_balance(creator) == 10_000
+    still_open = sorted({gid for ids in bot.open_game_ids for gid in ids})  # игра в нескольких тирах
+    assert still_open == sorted(set(game_ids) - set(taken))
+    assert sorted(bot._game_deadlines) == still_open
+    # создатель ни разу не стал соперником в своей игре: отказ на каждое нажатие
+    creator_answers = [text for uid, text in answers if uid == creator]
+    assert len(creator_answers) == len(game_ids)
+    assert set(creator_answers) <= {"Это ваша игра.", "Кто-то уже вступил!"}
+
+
+def test_join_is_completed_after_db_error(monkeypatch):
+    real_upsert = db.upsert_game
+    calls = []
+
+    async def flaky_upsert(game, user_ids=()):
+        calls.append(game["opponent_id"])
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await real_upsert(game, user_ids)
+
+    started: list[int] = []
+    monkeypatch.setattr(bot, "upsert_game", flaky_upsert)
+    monkeypatch.setattr(bot, "start_game", started.append)
+    creator, joiner, bet = USERS[0], USERS[1], 100
+
+    async def scenario():
+        await db.init_db()
+        try:
+            await bot.ensure_users(creator, joiner)
+            bot.set_balance(joiner, 300)
+            await real_upsert(_open_game(1, creator, bet))
+            await bot.cb_join_confirm(FakeCallback(joiner, 1, []))
+            state = await db._load_state()
+            return state["games"], (await db.load_users([joiner]))[joiner][1]
+        finally:
+            await db.close_db()
+
+    stored, balance = asyncio.run(scenario())
+
+    assert calls == [joiner, joiner]
+    assert started == [1]
+    # в БД соперник и его списание — после рестарта игра доиграется, а не вернёт ставку создателю
+    assert [g["opponent_id"] for g in stored] == [joiner]
+    assert balance == 200
+
+
+class FakeMessage:
+    """Текст от пользователя: только то, что трогает process_text."""
+
+    def __init__(self, uid: int, text: str, replies: list):
+        self.from_user = SimpleNamespace(id=uid, username=None)
+        self.chat = SimpleNamespace(id=uid)
+        self.text = text
+        self._replies = replies
+
+    async def answer(self, text, **kwargs):
+        self._replies.append(text)
+
+
+def test_transfer_survives_db_error_and_is_not_repeated(monkeypatch):
+    real_add_transfer = db.add_transfer
+    calls = []
+
+    async def flaky_add_transfer(from_user, to_user, amount):
+        calls.append(amount)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await real_add_transfer(from_user, to_user, amount)
+
+    monkeypatch.setattr(bot, "add_transfer", flaky_add_transfer)
+    monkeypatch.setattr(bot, "queue_message", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "pending_transfer_step", {})
+    monkeypatch.setattr(bot, "temp_transfer", {})
+    sender, target = USERS[0], USERS[1]
+    replies: list[str] = []
+
+    async def scenario():
+        await db.init_db()
+        try:
+            await bot.ensure_users(sender, target)
+            bot.set_balance(sender, 500)
+            bot.pending_transfer_step[sender] = "amount_transfer"
+            bot.temp_transfer[sender] = {"target_id": target}
+            await bot.process_text(FakeMessage(sender, "200", replies))
+            # тот же ввод ещё раз — перевод уже выполнен, шаг сброшен
+            await bot.process_text(FakeMessage(sender, "200", replies))
+            async with db._read() as conn:
+                async with conn.execute("SELECT from_user, to_user, amount FROM transfers") as cur:
+                    rows = [tuple(row) for row in await cur.fetchall()]
+            balances = await db.load_users([sender, target])
+            return rows, {uid: bal for uid, (_, bal) in balances.items()}
+        finally:
+            await db.close_db()
+
+    rows, balances = asyncio.run(scenario())
+
+    assert calls == [200, 200]  # первая запись упала и повторилась
+    assert rows == [(sender, target, 200)]
+    # балансы записаны той же транзакцией, что и строка перевода
+    assert balances == {sender: 300, target: 200}
+    assert sender not in bot.pending_transfer_step
+    assert replies[0].startswith("✅ Перевод выполнен.")
+    assert not any(r.startswith("✅ Перевод") for r in replies[1:])
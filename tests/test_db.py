@@ -0,0 +1,178 @@
+import asyncio
+from datetime import datetime, UTC
+
+import db
+
+
+def _game(gid, creator_id, opponent_id=None, bet=100):
+    return {
+        "id": gid,
+        "creator_id": creator_id,
+        "opponent_id": opponent_id,
+        "bet": bet,
+        "finished": False,
+        "created_at": datetime.now(UTC),
+    }
+
+
+async def _balances(*uids):
+    return {uid: bal for uid, (_, bal) in (await db.load_users(list(uids))).items()}
+
+
+def test_stake_is_written_with_the_game(db_path):
+    async def scenario():
+        await db.init_db()
+        try:
+            db.queue_user_update(1, balance=900)
+            db.queue_user_update(2, balance=50)  # чужое изменение ждёт обычного сброса
+            await db.upsert_game(_game(7, 1), (1,))
+            # падение сразу после записи игры: ставка уже списана в БД
+            after_game = await _balances(1, 2)
+            still_pending = db.is_user_dirty(2), db.is_user_dirty(1)
+
+            db.queue_user_update(3, balance=400)
+            await db.add_raffle_bet(1, 3, 100)
+            after_bet = await _balances(3)
+            return after_game, still_pending, after_bet
+        finally:
+            await db.close_db()
+
+    after_game, still_pending, after_bet = asyncio.run(scenario())
+
+    assert after_game == {1: 900}
+    assert still_pending == (True, False)
+    assert after_bet == {3: 400}
+
+
+def test_failed_transaction_requeues_users(db_path):
+    async def scenario():
+        await db.init_db()
+        try:
+            db.queue_user_update(1, balance=900)
+            try:
+                await db.upsert_game({"id": 7, "created_at": "не datetime"}, (1,))
+            except AttributeError:
+                pass
+            return db.is_user_dirty(1), await _balances(1)
+        finally:
+            await db.close_db()
+
+    dirty, balances = asyncio.run(scenario())
+
+    # транзакция откатилась вместе с балансом, но изменение вернулось в очередь
+    assert dirty
+    assert balances == {}
+
+
+async def _no_state():
+    return {}
+
+
+def test_open_state_migration_keeps_stranded_rows(db_path, monkeypatch, capsys):
+    migrations, load_state = db._MIGRATIONS, db._load_state
+    upto = migrations.index(db._migration_open_state)
+
+    async def scenario():
+        # база до миграции: незавершённые игры и раунд без розыгрыша
+        monkeypatch.setattr(db, "_MIGRATIONS", migrations[:upto])
+        monkeypatch.setattr(db, "_load_state", _no_state)  # он читает уже новую схему
+        await db.init_db()
+        try:
+            async with db._write() as conn:
+                await conn.executemany(
+                    "INSERT INTO games (id, creator_id, opponent_id, bet, finished, created_at)"
+                    " VALUES (?, ?, ?, ?, 0, '2025-01-01T00:00:00+00:00')",
+                    [(1, 11, 12, 300), (2, 11, None, 50)],
+                )
+                await conn.execute(
+                    "INSERT INTO raffle_rounds (id, created_at, total_bank)"
+                    " VALUES (1, '2025-01-01T00:00:00+00:00', 70)"
+                )
+                await conn.execute(
+                    "INSERT INTO raffle_bets (round_id, user_id, amount) VALUES (1, 13, 70)"
+                )
+        finally:
+            await db.close_db()
+
+        monkeypatch.setattr(db, "_MIGRATIONS", migrations)
+        monkeypatch.setattr(db, "_load_state", load_state)
+        state = await db.init_db()
+        try:
+            async with db._read() as conn:
+                async with conn.execute("SELECT id, abandoned FROM games ORDER BY id") as cur:
+                    games = [tuple(row) for row in await cur.fetchall()]
+                async with conn.execute("SELECT abandoned, finished_at FROM raffle_rounds") as cur:
+                    rounds = [tuple(row) for row in await cur.fetchall()]
+            return state, games, rounds
+        finally:
+            await db.close_db()
+
+    state, games, rounds = asyncio.run(scenario())
+
+    assert state["games"] == [] and state["raffle_rounds"] == []
+    assert state["next_game_id"] == 3 and state["next_raffle_id"] == 2
+    assert games == [(1, 1), (2, 1)]
+    assert rounds[0][0] == 1 and rounds[0][1] is not None
+    out = capsys.readouterr().out
+    # к возврату — только вступившая игра и розыгрыш; игра без соперника — отдельно
+    assert "Не возвращены (игры с соперником, розыгрыши): 670 монет у 3 игроков" in out
+    assert "11: 300 монет (ставок: 1)" in out
+    assert "Игры без соперника: 1 шт." in out
+    assert "игра №2: 11, ставка 50 монет" in out
+
+
+def test_flusher_waiting_for_the_lock_leaves_the_stake_to_the_game_write(db_path):
+    async def scenario():
+        await db.init_db()
+        try:
+            # идёт чужая запись; сброс пользователей уже ждёт замка
+            await db._write_lock.acquire()
+            flush = asyncio.create_task(db.flush_users())
+            db.queue_user_update(2, balance=50)
+            await asyncio.sleep(0)
+            # ставка списана, и игра встаёт в очередь за замком после сброса
+            db.queue_user_update(1, balance=900)
+            game = asyncio.create_task(db.upsert_game({"id": 7, "created_at": "не datetime"}, (1,)))
+            await asyncio.sleep(0)
+            db._write_lock.release()
+            await flush
+            try:
+                await game  # запись игры падает и откатывается
+            except AttributeError:
+                pass
+            return await _balances(1, 2), db.is_user_dirty(1)
+        finally:
+            await db.close_db()
+
+    balances, dirty = asyncio.run(scenario())
+
+    # сброс записал только чужое изменение: баланс 1 откатился вместе с игрой
+    assert balances == {2: 50}
+    assert dirty
+
+
+def test_failed_migration_leaves_no_partial_schema(db_path, monkeypatch):
+    async def broken_step(conn):
+        raise RuntimeError("миграция упала")
+
+    migrations = db._MIGRATIONS
+
+    async def scenario():
+        monkeypatch.setattr(db, "_MIGRATIONS", migrations + [broken_step])
+        try:
+            await db.init_db()
+        except RuntimeError:
+            pass
+        finally:
+            await db.close_db()
+        # следующий старт без сломанного шага проходит все миграции заново
+        monkeypatch.setattr(db, "_MIGRATIONS", migrations)
+        try:
+            await db.init_db()
+            async with db._read() as conn:
+                async with conn.execute("PRAGMA user_version") as cur:
+                    return (await cur.fetchone())[0]
+        finally:
+            await db.close_db()
+
+    assert asyncio.run(scenario()) == len(migrations)
@@ -0,0 +1,171 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, UTC
+
+import pytest
+
+import bot
+import db
+from fair import new_server_seed, seed_hash
+from raffle import new_raffle_round, raffle_add_bet
+
+CREATOR, OPPONENT, BET = 1001, 1002, 100
+
+
+@pytest.fixture(autouse=True)
+def fresh_bot_state(db_path, monkeypatch):
+    monkeypatch.setattr(bot, "games", {})
+    monkeypatch.setattr(bot, "recent_games", OrderedDict())
+    monkeypatch.setattr(bot, "user_balances", OrderedDict())
+    monkeypatch.setattr(bot, "_game_tasks", set())
+    monkeypatch.setattr(bot, "raffle_rounds", {})
+    monkeypatch.setattr(bot, "raffle_tasks", {})
+    monkeypatch.setattr(bot, "queue_message", lambda *args, **kwargs: None)
+
+
+def _joined_game(gid):
+    seed = new_server_seed()
+    return {
+        "id": gid,
+        "creator_id": CREATOR,
+        "opponent_id": OPPONENT,
+        "bet": BET,
+        "creator_roll": None,
+        "opponent_roll": None,
+        "winner": None,
+        "finished": False,
+        "created_at": datetime.now(UTC),
+        "finished_at": None,
+        "roll_engine": "server",
+        "server_seed": seed,
+        "seed_hash": seed_hash(seed),
+        "client_seed": "join",
+    }
+
+
+async def _with_joined_game(body):
+    """Оба игрока сделали ставку по BET с 1000 монет, игра записана вместе со списаниями."""
+    await db.init_db()
+    try:
+        await bot.ensure_users(CREATOR, OPPONENT, bot.MAIN_ADMIN_ID)
+        g = _joined_game(1)
+        bot.games[1] = g
+        for uid in (CREATOR, OPPONENT):
+            bot.set_balance(uid, 1000 - BET)
+        await db.upsert_game(g, (CREATOR, OPPONENT))
+        await body(g)
+        await db.flush_users()
+        return (await db._load_state())["games"], {
+            uid: bal for uid, (_, bal) in (await db.load_users([CREATOR, OPPONENT])).items()
+        }
+    finally:
+        await db.close_db()
+
+
+def test_failed_game_is_refunded_and_not_restored(monkeypatch):
+    async def broken_play(gid):
+        raise RuntimeError("Telegram недоступен")
+
+    monkeypatch.setattr(bot, "play_game", broken_play)
+
+    async def body(g):
+        await bot._run_game(g["id"])
+
+    restored, balances = asyncio.run(_with_joined_game(body))
+
+    assert restored == []
+    assert balances == {CREATOR: 1000, OPPONENT: 1000}
+    assert bot.games == {}
+
+
+def test_failure_after_settlement_retires_game(monkeypatch):
+    def broken_notify(*args, **kwargs):
+        raise RuntimeError("outbox упал")
+
+    monkeypatch.setattr(bot, "queue_message", broken_notify)
+
+    async def body(g):
+        await bot._run_game(g["id"])
+
+    restored, balances = asyncio.run(_with_joined_game(body))
+
+    # игра сыграна и записана: не висит в games и не доигрывается после рестарта
+    assert restored == []
+    assert bot.games == {}
+    assert bot.recent_games[1]["finished"]
+    # ставки не вернули поверх выплаты: в сумме у игроков банк минус комиссия (или ничья)
+    assert sum(balances.values()) in (2000, 2000 - 2 * BET // 100)
+
+
+def test_raffle_draw_retries_db_errors(monkeypatch):
+    real_upsert = db.upsert_raffle_round
+    calls = []
+
+    async def flaky_upsert(raffle_round, user_ids=()):
+        calls.append(raffle_round["id"])
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await real_upsert(raffle_round, user_ids)
+
+    monkeypatch.setattr(bot, "upsert_raffle_round", flaky_upsert)
+    monkeypatch.setattr(bot, "track_raffle_delivery", lambda *args: None)
+
+    async def scenario():
+        await db.init_db()
+        try:
+            raffle_round = new_raffle_round(1)
+            await real_upsert(raffle_round)
+            await bot.ensure_users(CREATOR, OPPONENT, bot.MAIN_ADMIN_ID)
+            for uid in (CREATOR, OPPONENT):
+                bot.set_balance(uid, 1000 - BET)
+                raffle_add_bet(raffle_round, uid, BET)
+            bot.raffle_rounds[0] = raffle_round
+            await bot.perform_raffle_draw(0)
+            await db.flush_users()
+            state = await db._load_state()
+            balances = await db.load_users([CREATOR, OPPONENT])
+            return state["raffle_rounds"], {uid: bal for uid, (_, bal) in balances.items()}
+        finally:
+            await db.close_db()
+
+    open_rounds, balances = asyncio.run(scenario())
+
+    # запись раунда повторилась после ошибки: раунд закрыт, выплата одна
+    assert calls == [1, 1]
+    assert open_rounds == []
+    assert sorted(balances.values()) == [1000 - BET, 1000 - BET + 2 * BET - 2 * BET // 100]
+
+
+def test_expired_game_row_is_deleted_despite_db_error(monkeypatch):
+    real_delete = db.delete_game
+    calls = []
+
+    async def flaky_delete(gid, user_ids=()):
+        calls.append(gid)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await real_delete(gid, user_ids)
+
+    monkeypatch.setattr(bot, "delete_game", flaky_delete)
+
+    async def scenario():
+        await db.init_db()
+        try:
+            await bot.ensure_users(CREATOR)
+            g = {**_joined_game(1), "opponent_id": None}
+            bot.games[1] = g
+            bot.set_balance(CREATOR, 1000 - BET)
+            await db.upsert_game(g, (CREATOR,))
+            await bot.expire_game(1)
+            await db.flush_users()
+            state = await db._load_state()
+            return state["games"], (await db.load_users([CREATOR]))[CREATOR][1]
+        finally:
+            await db.close_db()
+
+    restored, balance = asyncio.run(scenario())
+
+    # строка удалена вместе с возвратом: после рестарта игра не вернётся и не истечёт снова
+    assert calls == [1, 1]
+    assert restored == []
+    assert balance == 1000
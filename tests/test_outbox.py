@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import time
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import outbox
+
+
+class FakeBot:
+    """Вместо Bot API: запоминает (время, chat_id, текст) и умеет отвечать ошибками."""
+
+    def __init__(self, fail=None):
+        self.sent: list[tuple[float, int, str]] = []
+        self.fail = fail or (lambda chat_id, text, attempt: None)
+        self.attempts: dict[str, int] = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        attempt = self.attempts[text] = self.attempts.get(text, 0) + 1
+        error = self.fail(chat_id, text, attempt)
+        if error is not None:
+            raise error
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+@pytest.fixture(autouse=True)
+def fresh_outbox(monkeypatch):
+    """Состояние outbox — глобальное; каждому тесту своя очередь и свои счётчики."""
+    monkeypatch.setattr(outbox, "_queue", None)
+    monkeypatch.setattr(outbox, "_senders", [])
+    monkeypatch.setattr(outbox, "_seq", itertools.count())
+    monkeypatch.setattr(outbox, "_chat_next_at", {})
+    monkeypatch.setattr(outbox, "_chat_flood_until", {})
+    monkeypatch.setattr(outbox, "_chat_epoch", {})
+    monkeypatch.setattr(outbox, "_chat_pending", {})
+    monkeypatch.setattr(outbox, "_pruned_at", 0.0)
+    monkeypatch.setattr(outbox, "_tokens", float(outbox.OUTBOX_GLOBAL_RATE))
+    monkeypatch.setattr(outbox, "_tokens_at", 0.0)
+    monkeypatch.setattr(outbox, "outbox_stats", {k: 0 for k in outbox.outbox_stats})
+    monkeypatch.setattr(outbox, "_pending_by_priority", {p: 0 for p in outbox._PRIORITY_NAMES})
+
+
+def _retry_after(chat_id, seconds):
+    return TelegramRetryAfter(
+        method=SendMessage(chat_id=chat_id, text="x"), message="Flood", retry_after=seconds
+    )
+
+
+async def _deliver(fake, messages, timeout=10):
+    """Поставить сообщения (chat_id, text, priority) и дождаться итогов."""
+    results = [outbox.queue_message(chat_id, text, priority) for chat_id, text, priority in messages]
+    outbox.start_outbox(fake)
+    try:
+        return await asyncio.wait_for(asyncio.gather(*results), timeout)
+    finally:
+        await outbox.close_outbox(timeout=0)
+
+
+def test_global_rate_is_limited(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_GLOBAL_RATE", 50)
+    monkeypatch.setattr(outbox, "_tokens", 50.0)
+    fake = FakeBot()
+    # 150 разных чатов: ограничивает только общий token bucket (50 сразу + 100 по 50/с)
+    messages = [(chat_id, f"m{chat_id}", outbox.PRIORITY_NORMAL) for chat_id in range(150)]
+
+    started = time.monotonic()
+    results = asyncio.run(_deliver(fake, messages))
+
+    assert results == ["sent"] * 150
+    assert time.monotonic() - started >= 1.8
+    # в любую секунду — не больше ёмкости ведра + скорости
+    times = sorted(t for t, _, _ in fake.sent)
+    for i, t in enumerate(times):
+        in_window = sum(1 for u in times[i:] if u - t < 1.0)
+        assert in_window <= 50 + 50 + 1
+
+
+def test_messages_to_one_chat_are_spaced(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_PER_CHAT_INTERVAL", 0.2)
+    fake = FakeBot()
+    messages = [(7, f"m{i}", outbox.PRIORITY_NORMAL) for i in range(4)]
+
+    asyncio.run(_deliver(fake, messages))
+
+    times = [t for t, _, _ in fake.sent]
+    assert [text for _, _, text in fake.sent] == ["m0", "m1", "m2", "m3"]
+    assert all(b - a >= 0.19 for a, b in zip(times, times[1:]))
+
+
+def test_priority_order(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_SENDERS", 1)
+    fake = FakeBot()
+    messages = [
+        (1, "admin", outbox.PRIORITY_ADMIN),
+        (2, "normal", outbox.PRIORITY_NORMAL),
+        (3, "game-1", outbox.PRIORITY_GAME),
+        (4, "game-2", outbox.PRIORITY_GAME),
+    ]
+
+    asyncio.run(_deliver(fake, messages))
+
+    assert [text for _, _, text in fake.sent] == ["game-1", "game-2", "normal", "admin"]
+
+
+def test_retry_after_pauses_chat_and_reslots(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_PER_CHAT_INTERVAL", 0.2)
+
+    def fail(chat_id, text, attempt):
+        if text == "m0" and attempt == 1:
+            return _retry_after(chat_id, 1)
+        return None
+
+    fake = FakeBot(fail)
+    messages = [(7, f"m{i}", outbox.PRIORITY_NORMAL) for i in range(3)]
+    messages.append((8, "other", outbox.PRIORITY_NORMAL))
+
+    started = time.monotonic()
+    results = asyncio.run(_deliver(fake, messages))
+
+    assert results == ["sent"] * 4
+    assert outbox.outbox_stats["retry_after"] == 1
+    by_chat = {}
+    for t, chat_id, text in fake.sent:
+        by_chat.setdefault(chat_id, []).append((t - started, text))
+    # другой чат паузой не задет
+    assert by_chat[8][0][0] < 0.5
+    # чат 7 молчит до конца RetryAfter, потом сообщения снова идут с интервалом
+    times = [t for t, _ in by_chat[7]]
+    assert len(times) == 3
+    assert times[0] >= 0.95
+    assert all(b - a >= 0.19 for a, b in zip(times, times[1:]))
+
+
+def test_blocked_chat_is_reported():
+    def fail(chat_id, text, attempt):
+        return TelegramForbiddenError(
+            method=SendMessage(chat_id=chat_id, text=text), message="blocked"
+        )
+
+    results = asyncio.run(_deliver(FakeBot(fail), [(9, "hi", outbox.PRIORITY_GAME)]))
+
+    assert results == ["blocked"]
+    assert outbox.outbox_depth() == 0
+
+
+def test_per_chat_state_is_pruned(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_PER_CHAT_INTERVAL", 0.2)
+    monkeypatch.setattr(outbox, "OUTBOX_PRUNE_INTERVAL", 0.3)
+
+    def fail(chat_id, text, attempt):
+        if text == "flood" and attempt == 1:
+            return _retry_after(chat_id, 0.2)
+        return None
+
+    fake = FakeBot(fail)
+    messages = [(chat_id, f"m{chat_id}", outbox.PRIORITY_NORMAL) for chat_id in range(100)]
+    messages.append((100, "flood", outbox.PRIORITY_NORMAL))
+
+    async def scenario():
+        await _deliver(fake, messages)
+        epochs_after_batch = len(outbox._chat_epoch)
+        await asyncio.sleep(0.5)
+        # следующее сообщение в другой чат запускает чистку
+        await _deliver(fake, [(500, "later", outbox.PRIORITY_NORMAL)])
+        return epochs_after_batch
+
+    epochs_after_batch = asyncio.run(scenario())
+
+    assert outbox.outbox_stats["retry_after"] == 1
+    assert epochs_after_batch == 0  # эпоха RetryAfter забыта, как только сообщения чата ушли
+    assert set(outbox._chat_next_at) == {500}
+    assert outbox._chat_flood_until == {}
+    assert outbox._chat_pending == {}
@@ -0,0 +1,56 @@
+import math
+from collections import Counter
+
+import raffle
+from raffle import new_raffle_round, raffle_add_bet, raffle_draw
+
+DRAWS = 1_000_000
+
+
+def _round(bets):
+    raffle_round = new_raffle_round(1)
+    for uid, amount in bets:
+        raffle_add_bet(raffle_round, uid, amount)
+    return raffle_round
+
+
+def test_draw_frequencies_match_stakes():
+    # у игрока 1 две ставки не подряд; игрок 4 — «мелкий» с шансом ~0.7%
+    raffle_round = _round([(1, 500), (2, 300), (3, 1000), (1, 250), (4, 15)])
+    total = raffle_round["total_bank"]
+
+    wins = Counter(raffle_draw(raffle_round) for _ in range(DRAWS))
+
+    assert set(wins) == set(raffle_round["bets"])
+    chi2 = 0.0
+    for uid, stake in raffle_round["bets"].items():
+        p = stake / total
+        expected = DRAWS * p
+        sigma = math.sqrt(DRAWS * p * (1 - p))
+        assert abs(wins[uid] - expected) < 5 * sigma, (uid, wins[uid], expected)
+        chi2 += (wins[uid] - expected) ** 2 / expected
+    # 3 степени свободы: P(chi2 > 27.9) ≈ 4e-6
+    assert chi2 < 27.9
+
+
+def test_every_ticket_goes_to_its_owner(monkeypatch):
+    bets = [(1, 3), (2, 1), (3, 5), (1, 2)]
+    raffle_round = _round(bets)
+    owners = [uid for uid, amount in bets for _ in range(amount)]
+    assert len(owners) == raffle_round["total_bank"]
+
+    # все билеты подряд: 0, total_bank-1 и обе стороны каждой границы cumulative
+    for ticket, owner in enumerate(owners):
+        monkeypatch.setattr(raffle.secrets, "randbelow", lambda n, t=ticket: t)
+        assert raffle_draw(raffle_round) == owner, ticket
+
+
+def test_boundary_tickets_in_large_bank(monkeypatch):
+    raffle_round = _round([(1, 10**9), (2, 1), (3, 10**9)])
+    first, second, total = raffle_round["cumulative"]
+
+    for ticket, owner in [
+        (0, 1), (first - 1, 1), (first, 2), (second - 1, 2), (second, 3), (total - 1, 3)
+    ]:
+        monkeypatch.setattr(raffle.secrets, "randbelow", lambda n, t=ticket: t)
+        assert raffle_draw(raffle_round) == owner, ticket
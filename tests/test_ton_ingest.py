@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+import bot
+import db
+import http_client
+from tonapi_stub import STUB_RUB_RATE as RATE, TonapiStub, make_burst, make_tx
+
+WALLET = "stub-wallet"
+USERS = [100001, 100002, 100003, 100004, 100005]
+
+
+@pytest.fixture(autouse=True)
+def fresh_pipeline(monkeypatch):
+    """Очереди конвейера привязаны к циклу событий — каждому тесту новые."""
+    monkeypatch.setattr(bot, "_deposit_credit_queue", asyncio.Queue(maxsize=bot.TON_CREDIT_QUEUE_SIZE))
+    monkeypatch.setattr(bot, "_deposit_notify_queue", asyncio.Queue())
+    monkeypatch.setattr(bot, "_ton_enqueued_lt", {})
+    monkeypatch.setattr(bot, "user_balances", type(bot.user_balances)())
+    # курс тоже берётся у заглушки
+    monkeypatch.setattr(bot, "_ton_rate_cache", {"value": 0.0, "updated": bot._ton_rate_cache["updated"]})
+    monkeypatch.setattr(bot, "_ton_rate_refresh", None)
+
+
+async def _with_stub(monkeypatch, body):
+    """Поднять заглушку tonapi, направить на неё бота и запустить стадию зачисления."""
+    stub = TonapiStub()
+    server = TestServer(stub.make_app())
+    await server.start_server()
+    monkeypatch.setattr(bot, "TONAPI_BASE_URL", str(server.make_url("/v2")))
+    monkeypatch.setattr(bot, "TONAPI_RATES_URL", str(server.make_url("/v2/rates")))
+    await db.init_db()
+    credit = asyncio.create_task(bot.deposit_credit_worker())
+    try:
+        return await body(stub)
+    finally:
+        credit.cancel()
+        await http_client.close_http()
+        await db.close_db()
+        await server.close()
+
+
+def _expected_credits(txs):
+    credits = {}
+    for tx in txs:
+        parsed = bot.parse_ton_deposit(tx)
+        if parsed:
+            uid, nanoton, _ = parsed
+            credits[uid] = credits.get(uid, 0) + int(nanoton / 1e9 * RATE)
+    return credits
+
+
+def test_burst_replay_credits_each_deposit_once(db_path, monkeypatch):
+    burst = make_burst(1001, 637, USERS)
+
+    async def body(stub):
+        # курсор стоит перед всплеском, как будто бот пропустил его целиком
+        await db.add_ton_deposits(WALLET, 1000, [], {})
+        stub.add_transactions([make_tx(lt, USERS[0]) for lt in range(990, 1001)])
+        stub.add_transactions(burst)
+
+        await bot.poll_ton_deposits(WALLET)
+        await bot._deposit_credit_queue.join()
+        # повторный проход ничего не находит и не зачисляет
+        await bot.poll_ton_deposits(WALLET)
+        await bot._deposit_credit_queue.join()
+
+        balances = await db.load_users(USERS)
+        return stub.requests, balances, await db.get_ton_cursor(WALLET)
+
+    requests, balances, cursor = asyncio.run(_with_stub(monkeypatch, body))
+
+    expected = _expected_credits(burst)
+    assert {uid: bal for uid, (_, bal) in balances.items()} == expected
+    assert {uid: bot.get_balance(uid) for uid in USERS} == expected
+    assert cursor == 1637
+    # 637 транзакций новее курсора — 7 страниц по 100, плюс одна страница на второй проход
+    assert requests == 8
+    assert bot._deposit_notify_queue.qsize() == sum(1 for tx in burst if bot.parse_ton_deposit(tx))
+
+
+def test_sse_stream_triggers_catch_up(db_path, monkeypatch):
+    async def body(stub):
+        await db.add_ton_deposits(WALLET, 1000, [], {})
+        stub.add_transactions([make_tx(1001, USERS[0])])
+
+        stream = asyncio.create_task(bot.run_ton_stream(WALLET))
+        while not stub.subscribers or bot.ton_ingest_mode != "streaming":
+            await asyncio.sleep(0.01)
+        await bot._deposit_credit_queue.join()
+        after_catch_up = bot.get_balance(USERS[0])
+
+        stub.add_transactions([make_tx(1002, USERS[1]), make_tx(1003, USERS[1])])
+        stub.publish({"account_id": WALLET, "lt": 1003, "tx_hash": "tx1003"})
+        while await db.get_ton_cursor(WALLET) < 1003:
+            await asyncio.sleep(0.01)
+        await bot._deposit_credit_queue.join()
+
+        stub.publish(None)  # сервер закрыл поток — run_ton_stream возвращается
+        await asyncio.wait_for(stream, 5)
+        return after_catch_up, bot.ton_ingest_mode
+
+    after_catch_up, mode = asyncio.run(_with_stub(monkeypatch, body))
+
+    assert after_catch_up == int(RATE)
+    assert bot.get_balance(USERS[1]) == 2 * int(RATE)
+    assert mode == "polling"
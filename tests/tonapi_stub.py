@@ -0,0 +1,103 @@
+"""Локальная заглушка tonapi для проверки приёма пополнений TON без сети.
+
+Отдаёт то, чем пользуется бот:
+- GET /v2/blockchain/accounts/{wallet}/transactions?limit&before_lt — страницы от новых к старым;
+- GET /v2/sse/accounts/transactions?accounts=... — SSE-поток (heartbeat + события из publish);
+- GET /v2/rates — курс TON в рублях.
+
+В тестах: TonapiStub().make_app(), дальше add_transactions()/publish(). Вручную:
+    python tests/tonapi_stub.py --port 8081 --burst 600 --user-id 100001
+и TONAPI_BASE_URL = "http://127.0.0.1:8081/v2" в bot.py.
+"""
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+STUB_RUB_RATE = 500.0
+
+
+def make_tx(lt: int, user_id: int | None = None, nanoton: int = 1_000_000_000) -> dict:
+    """Транзакция в формате tonapi; user_id=None — перевод без комментария ID<user_id>."""
+    in_msg = {"value": str(nanoton)}
+    if user_id is not None:
+        in_msg["msg_data"] = {"text": f"ID{user_id}"}
+    return {"hash": f"tx{lt}", "lt": lt, "in_msg": in_msg}
+
+
+def make_burst(first_lt: int, count: int, user_ids: list[int]) -> list[dict]:
+    """count транзакций подряд: каждая третья — без комментария (не пополнение)."""
+    return [
+        make_tx(lt, None if i % 3 == 2 else user_ids[i % len(user_ids)])
+        for i, lt in enumerate(range(first_lt, first_lt + count))
+    ]
+
+
+class TonapiStub:
+    def __init__(self):
+        self.transactions: list[dict] = []  # от новых к старым, как отдаёт tonapi
+        self.subscribers: list[asyncio.Queue] = []
+        self.requests = 0  # запросов к списку транзакций
+
+    def add_transactions(self, txs: list[dict]):
+        self.transactions.extend(txs)
+        self.transactions.sort(key=lambda tx: tx["lt"], reverse=True)
+
+    def publish(self, event: dict | None):
+        """Отправить событие всем SSE-подписчикам; None закрывает поток."""
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    async def _transactions(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        limit = int(request.query.get("limit", 100))
+        before_lt = request.query.get("before_lt")
+        txs = self.transactions
+        if before_lt is not None:
+            txs = [tx for tx in txs if tx["lt"] < int(before_lt)]
+        return web.json_response({"transactions": txs[:limit]})
+
+    async def _rates(self, request: web.Request) -> web.Response:
+        return web.json_response({"rates": {"TON": {"prices": {"RUB": STUB_RUB_RATE}}}})
+
+    async def _sse(self, request: web.Request) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        try:
+            await resp.write(b"event: heartbeat\ndata: {}\n\n")
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                await resp.write(f"event: message\ndata: {json.dumps(event)}\n\n".encode())
+        finally:
+            self.subscribers.remove(queue)
+        return resp
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/v2/blockchain/accounts/{wallet}/transactions", self._transactions)
+        app.router.add_get("/v2/sse/accounts/transactions", self._sse)
+        app.router.add_get("/v2/rates", self._rates)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--burst", type=int, default=0, help="сколько транзакций подгрузить")
+    parser.add_argument("--user-id", type=int, action="append", default=[],
+                        help="получатель пополнений (можно несколько)")
+    args = parser.parse_args()
+
+    stub = TonapiStub()
+    if args.burst:
+        stub.add_transactions(make_burst(1, args.burst, args.user_id or [100001]))
+    web.run_app(stub.make_app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()